@@ -0,0 +1,272 @@
+import inspect
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from transforms import elastic_displacement_scale
+
+
+# the sampling grids address pixel centers, with -1 and 1 being the centers of the first and the last pixel
+grid_sample_args = {"align_corners": True} if "align_corners" in inspect.signature(F.grid_sample).parameters else {}
+
+
+class BatchTransform:
+    """
+    Prepares collated batches of raw samples (see TrainDataset with raw=True) for the model, as TrainDataset does
+    per sample: the augmentation of transforms.augment with per-sample random parameters, the mask weights, the
+    padding or resizing to the target size and the normalization.
+    The geometric augmentations (flip, elastic and affine warp, crop and pad) are composed into one sampling grid, so
+    a batch is warped by a single grid_sample, and brightness and gamma are a per-sample lookup table.
+    The batch is transformed on the device it is on, the random parameters are drawn from np.random.
+    """
+
+    def __init__(self, image_size_target, augment):
+        self.image_size_target = image_size_target
+        self.augment = augment
+
+    def __call__(self, batch):
+        images, masks, mask_weight_factors, has_salt = batch
+
+        if self.augment:
+            images, masks = augment_batch(images, masks)
+        else:
+            images, masks = images.float(), masks.float()
+
+        mask_weights = calculate_mask_weights_batch(masks) * mask_weight_factors.view(-1, 1, 1, 1)
+
+        images = resize_batch(images, self.image_size_target)
+        masks = resize_batch(masks, self.image_size_target)
+        mask_weights = resize_batch(mask_weights, self.image_size_target)
+
+        image_mean = 0.4719
+        image_std = 0.1610
+
+        images = (images / 255 - image_mean) / image_std
+
+        return images, masks, mask_weights, has_salt
+
+
+def augment_batch(images, masks):
+    batch_size, _, h, w = images.size()
+
+    flips = np.random.rand(batch_size) < 0.5
+
+    photometric = np.random.rand(batch_size) < 0.5
+    photometric_choices = np.random.choice(2, batch_size)
+    photometric_coefficients = np.random.uniform(1 - 0.1, 1 + 0.1, batch_size)
+    brightness_coefficients = np.where(photometric & (photometric_choices == 0), photometric_coefficients, 1.0)
+    gammas = np.where(photometric & (photometric_choices == 1), photometric_coefficients, 1.0)
+
+    # (alpha, sigma, alpha_affine) of the elastic transforms of transforms.augment
+    elastic_parameters = np.array([[0, 0, 0], [150, 8, 0], [0, 0, 8], [150, 10, 5]])
+    elastic = np.random.rand(batch_size) < 0.5
+    elastic_choices = np.where(elastic, np.random.choice(3, batch_size) + 1, 0)
+    alphas, sigmas, alpha_affines = elastic_parameters[elastic_choices].T
+
+    crop = np.random.rand(batch_size) < 0.5
+    crop_y = random_crops(h, crop)
+    crop_x = random_crops(w, crop)
+
+    tables = photometric_tables(brightness_coefficients, gammas).to(images.device)
+    images = lookup_batch(images, tables).float()
+
+    inverse_affines = torch.from_numpy(random_inverse_affines((h, w), alpha_affines)).float().to(images.device)
+    displacements = random_displacement_fields((h, w), alphas, sigmas, images.device)
+
+    grid = sampling_grid(
+        (h, w), torch.from_numpy(flips.astype(np.uint8)).to(images.device), inverse_affines, displacements,
+        torch.from_numpy(crop_y).to(images.device), torch.from_numpy(crop_x).to(images.device))
+
+    images = F.grid_sample(images, grid, mode="bilinear", **grid_sample_args)
+    masks = (F.grid_sample(masks.float(), grid, mode="bilinear", **grid_sample_args) > 0.5).float()
+
+    return images, masks
+
+
+def random_crops(size, enabled):
+    """
+    Draws the crops of transforms.random_crop_and_pad along one axis as (total, start) pairs, (0, 0) if disabled.
+    """
+    max_crop = 40
+    crops = np.zeros((len(enabled), 2), dtype=np.int64)
+    for i in np.flatnonzero(enabled):
+        crop_total = np.random.randint(max_crop)
+        crops[i] = crop_total, np.random.randint(crop_total + 1)
+    return crops
+
+
+def random_inverse_affines(shape_size, alpha_affines):
+    """
+    Draws the random affine transforms of transforms.elastic_transform and returns their inverses with the shape
+    (B, 2, 3), mapping output to input pixel coordinates.
+    """
+    center_square = np.float32(shape_size) // 2
+    square_size = min(shape_size) // 3
+    pts1 = np.float32([center_square + square_size, [center_square[0] + square_size, center_square[1] - square_size],
+                       center_square - square_size])
+
+    inverse_affines = np.zeros((len(alpha_affines), 2, 3), dtype=np.float64)
+    for i, alpha_affine in enumerate(alpha_affines):
+        pts2 = pts1 + np.random.uniform(-alpha_affine, alpha_affine, size=pts1.shape).astype(np.float32)
+        inverse_affines[i] = cv2.invertAffineTransform(cv2.getAffineTransform(pts1, pts2))
+    return inverse_affines
+
+
+def random_displacement_fields(shape_size, alphas, sigmas, device):
+    """
+    Draws smoothed random displacement fields as transforms.elastic_displacement_field with the shape (B, 2, H, W),
+    zero for the samples with alpha 0. The noise is drawn from np.random on the host, as all random parameters.
+    """
+    fields = torch.zeros((len(alphas), 2) + tuple(shape_size), device=device)
+    for alpha, sigma in sorted(set(zip(alphas, sigmas))):
+        if alpha == 0:
+            continue
+        indices = torch.from_numpy(np.flatnonzero((alphas == alpha) & (sigmas == sigma))).to(device)
+        noise = np.random.uniform(-1, 1, size=(len(indices) * 2, 1) + tuple(shape_size)).astype(np.float32)
+        noise = torch.from_numpy(noise).to(device)
+        field = gaussian_blur_batch(noise, sigma) * (alpha * elastic_displacement_scale)
+        fields[indices] = field.view(len(indices), 2, *shape_size)
+    return fields
+
+
+def gaussian_blur_batch(images, sigma):
+    # the kernel size of cv2.GaussianBlur for float images
+    radius = int(round(4 * sigma))
+    kernel = np.exp(-np.arange(-radius, radius + 1) ** 2 / (2 * sigma ** 2))
+    kernel = torch.from_numpy(kernel / kernel.sum()).float().to(images.device)
+
+    images = F.conv2d(F.pad(images, (radius, radius, 0, 0), mode="reflect"), kernel.view(1, 1, 1, -1))
+    images = F.conv2d(F.pad(images, (0, 0, radius, radius), mode="reflect"), kernel.view(1, 1, -1, 1))
+    return images
+
+
+def sampling_grid(shape_size, flips, inverse_affines, displacements, crop_y, crop_x):
+    """
+    Builds the grid_sample grid of the composition of a horizontal flip, an elastic transform and a crop and pad in
+    the order of transforms.augment, tracing every output pixel back to the input pixel it is sampled from.
+    The borders are reflected as with cv2.BORDER_REFLECT_101.
+    """
+    h, w = shape_size
+    batch_size = len(flips)
+    device = displacements.device
+
+    ys = torch.arange(0, h, device=device).long().view(1, h, 1).expand(batch_size, h, w)
+    xs = torch.arange(0, w, device=device).long().view(1, 1, w).expand(batch_size, h, w)
+
+    # crop and pad: the output is the crop padded back to the full size
+    ys = crop_coordinates(ys, h, crop_y)
+    xs = crop_coordinates(xs, w, crop_x)
+
+    # elastic transform: displaced positions mapped through the inverse affine transform
+    indices = (ys * w + xs).view(batch_size, 1, -1).expand(-1, 2, -1)
+    dx, dy = displacements.view(batch_size, 2, -1).gather(2, indices).view(batch_size, 2, h, w).unbind(1)
+    ys, xs = ys.float() + dy, xs.float() + dx
+    m = inverse_affines.view(batch_size, 6, 1, 1)
+    ys, xs = m[:, 3] * xs + m[:, 4] * ys + m[:, 5], m[:, 0] * xs + m[:, 1] * ys + m[:, 2]
+    ys = reflect_coordinates(ys, h)
+    xs = reflect_coordinates(xs, w)
+
+    # horizontal flip
+    xs = torch.where(flips.view(-1, 1, 1).expand_as(xs) > 0, (w - 1) - xs, xs)
+
+    return torch.stack([2 * xs / (w - 1) - 1, 2 * ys / (h - 1) - 1], dim=3)
+
+
+def crop_coordinates(coordinates, size, crops):
+    crop_totals = crops[:, 0].view(-1, 1, 1)
+    crop_starts = crops[:, 1].view(-1, 1, 1)
+    crop_sizes = size - crop_totals
+    # the padding of transforms.upsample starts with the larger half
+    padding_starts = (crop_totals + 1) // 2
+    return reflect_coordinates(coordinates - padding_starts, crop_sizes) + crop_starts
+
+
+def reflect_coordinates(coordinates, size):
+    period = 2 * (size - 1)
+    coordinates = torch.remainder(coordinates, period)
+    return torch.where(coordinates > size - 1, period - coordinates, coordinates)
+
+
+def photometric_tables(brightness_coefficients, gammas):
+    """
+    Builds the lookup tables of transforms.adjust_brightness_and_gamma for every sample as a (B, 256) tensor.
+    """
+    values = torch.arange(0, 256).double().view(1, -1)
+    brightness_coefficients = torch.from_numpy(np.asarray(brightness_coefficients, dtype=np.float64)).view(-1, 1)
+    gammas = torch.from_numpy(np.asarray(gammas, dtype=np.float64)).view(-1, 1)
+
+    values = (values * brightness_coefficients).clamp(max=255).floor()
+    values = ((values / 255.0) ** (1.0 / gammas) * 255).floor()
+    return values.byte()
+
+
+def lookup_batch(images, tables):
+    batch_size = images.size(0)
+    indices = images.view(batch_size, -1).long()
+    return tables.gather(1, indices).view_as(images)
+
+
+def calculate_mask_weights_batch(masks):
+    """
+    Calculates the weights of processing.calculate_mask_weights for a batch of binary masks (B, 1, H, W).
+    """
+    salt_mean = 0.247966
+
+    contours = calculate_contour_batch(masks)
+
+    weights = torch.zeros_like(masks)
+    weights[masks == 0] = salt_mean / (1.0 - salt_mean)
+    weights[masks == 1] = 1.0
+    weights[contours] = 3.0
+
+    return weights
+
+
+def calculate_contour_batch(masks, width=3):
+    """
+    Calculates the contours of processing.calculate_contour for a batch of masks (B, 1, H, W) as a byte tensor,
+    including the wrap around of every stage of the uint8 masks.
+    """
+    padded = F.pad(masks.float(), (1, 1, 1, 1), mode="replicate")
+    row_sums = padded[:, :, :-2] + padded[:, :, 1:-1] + padded[:, :, 2:]
+    column_sums = padded[..., :-2] + padded[..., 1:-1] + padded[..., 2:]
+    edge_x = torch.remainder(row_sums[..., :-2] - row_sums[..., 2:], 256)
+    edge_y = torch.remainder(column_sums[:, :, :-2] - column_sums[:, :, 2:], 256)
+    contours = torch.remainder(edge_x + edge_y, 256)
+
+    for _ in range(width - 1):
+        padded = F.pad(contours, (1, 1, 1, 1), mode="replicate")
+        row_sums = padded[:, :, :-2] + padded[:, :, 1:-1] + padded[:, :, 2:]
+        contours = torch.remainder(row_sums[..., :-2] + row_sums[..., 1:-1] + row_sums[..., 2:], 256)
+
+    return contours != 0
+
+
+def resize_batch(images, size):
+    h = images.size(2)
+    if h < size:
+        return pad_batch(images, size)
+    elif h > size:
+        return F.interpolate(images, size=(size, size), mode="bilinear")
+    return images
+
+
+def pad_batch(images, size):
+    """
+    Pads a batch (B, C, H, W) to size x size as transforms.upsample does per image, reflecting the borders as with
+    cv2.BORDER_REFLECT_101 and putting the larger half of odd paddings at the start.
+    """
+    padding_y, padding_x = size - images.size(2), size - images.size(3)
+    return F.pad(images, ((padding_x + 1) // 2, padding_x // 2, (padding_y + 1) // 2, padding_y // 2),
+                 mode="reflect")
+
+
+def crop_batch(images, size):
+    """
+    Crops the center size x size region of a batch (B, C, H, W) as transforms.downsample does per image, the inverse
+    of pad_batch.
+    """
+    start_y, start_x = (images.size(2) - size + 1) // 2, (images.size(3) - size + 1) // 2
+    return images[:, :, start_y:start_y + size, start_x:start_x + size]
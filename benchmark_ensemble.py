@@ -0,0 +1,76 @@
+import argparse
+import time
+
+import torch
+
+from ensemble import Ensemble
+from train import create_model, device
+
+
+def measure_throughput(ensemble_model, images, batch_count):
+    with torch.no_grad():
+        # the first batch warms up the allocator and the thread pools
+        ensemble_model(images)
+        start_time = time.perf_counter()
+        for _ in range(batch_count):
+            ensemble_model(images)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        duration = time.perf_counter() - start_time
+    return batch_count * images.size(0) / duration
+
+
+def main():
+    """
+    Compares the inference throughput of an ensemble of randomly initialized models with sequential member
+    execution against the concurrent one with the given numbers of member workers.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    models = [create_model(type=model_type, input_size=image_size, pretrained=False, parallel=False).to(device)
+              for _ in range(model_count)]
+    for m in models:
+        m.eval()
+
+    torch.manual_seed(0)
+    images = torch.randn(batch_size, 1, image_size, image_size, device=device)
+
+    print("device: %s, intra-op threads: %d, models: %d x %s, batch size: %d" % (
+        device, torch.get_num_threads(), model_count, model_type, batch_size))
+    print()
+    print("%-16s %12s %8s" % ("member_workers", "images/s", "speedup"))
+
+    sequential_throughput = measure_throughput(Ensemble(models), images, batch_count)
+    print("%-16d %12.2f %8.2f" % (1, sequential_throughput, 1.0))
+
+    for workers in member_workers:
+        if workers <= 1:
+            continue
+        ensemble_model = Ensemble(models, member_workers=workers)
+        throughput = measure_throughput(ensemble_model, images, batch_count)
+        ensemble_model.close()
+        print("%-16d %12.2f %8.2f" % (workers, throughput, throughput / sequential_throughput))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--model_type", default="unet_seresnext50_hc")
+    argparser.add_argument("--model_count", default=3, type=int)
+    argparser.add_argument("--image_size", default=128, type=int)
+    argparser.add_argument("--batch_size", default=8, type=int)
+    argparser.add_argument("--batch_count", default=5, type=int)
+    argparser.add_argument("--member_workers", default="2,3")
+    argparser.add_argument("--num_threads", type=int)
+
+    args = argparser.parse_args()
+
+    model_type = args.model_type
+    model_count = args.model_count
+    image_size = args.image_size
+    batch_size = args.batch_size
+    batch_count = args.batch_count
+    member_workers = [int(w) for w in args.member_workers.split(",")]
+    num_threads = args.num_threads
+
+    main()
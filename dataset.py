@@ -1,14 +1,28 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import cv2
 import numpy as np
 import pandas as pd
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
 from torchvision.transforms.functional import normalize
 
-from processing import calculate_mask_weights, rldec
+from batch_transforms import resize_batch
+from processing import calculate_mask_weights, calculate_mask_weights_batch, rldec_batch
 from transforms import augment, upsample, reduce_salt_coverage
 from utils import kfold_split
 
+glcm_feature_channels = {
+    "dissimilarity": (0, 4),
+    "contrast": (1, 5),
+    "homogeneity": (2, 6),
+    "energy": (3, 7)
+}
+
 
 class TrainData:
     def __init__(
@@ -21,14 +35,18 @@ class TrainData:
             pseudo_labeling_submission_csv,
             pseudo_labeling_test_fold_count,
             pseudo_labeling_test_fold_index,
-            pseudo_labeling_extend_val_set):
+            pseudo_labeling_extend_val_set,
+            cache_dir=None,
+            decode_workers=None):
 
         train_df = pd.read_csv("{}/train.csv".format(base_dir), index_col="id", usecols=[0])
         depths_df = pd.read_csv("{}/depths.csv".format(base_dir), index_col="id")
         train_df = train_df.join(depths_df)
 
-        train_df["images"] = load_images("{}/train/images".format(base_dir), train_df.index)
-        train_df["masks"] = load_masks("{}/train/masks".format(base_dir), train_df.index)
+        train_cache = DataCache(
+            base_dir, "train", depths_df, with_masks=True, cache_dir=cache_dir, decode_workers=decode_workers)
+        train_df["images"] = train_cache.select_images(train_df.index)
+        train_df["masks"] = train_cache.select_masks(train_df.index)
         train_df["coverage_class"] = train_df.masks.map(calculate_coverage_class)
 
         if use_val_set:
@@ -46,8 +64,10 @@ class TrainData:
         if pseudo_labeling_enabled:
             test_df = pd.read_csv(pseudo_labeling_submission_csv, index_col="id")
             test_df["rle_mask"] = test_df.rle_mask.astype(str)
-            test_df["masks"] = test_df.rle_mask.map(rldec)
-            test_df["images"] = load_images("{}/test/images".format(base_dir), test_df.index)
+            test_df["masks"] = list(rldec_batch(test_df.rle_mask.values))
+            test_cache = DataCache(
+                base_dir, "test", depths_df, with_masks=False, cache_dir=cache_dir, decode_workers=decode_workers)
+            test_df["images"] = test_cache.select_images(test_df.index)
             test_df["coverage_class"] = test_df.masks.map(calculate_coverage_class)
             test_df = test_df.drop(columns=["rle_mask"])
 
@@ -131,97 +151,227 @@ class TrainData:
 
 
 class TestData:
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, cache_dir=None, decode_workers=None):
         train_df = pd.read_csv("{}/train.csv".format(base_dir), index_col="id", usecols=[0])
         depths_df = pd.read_csv("{}/depths.csv".format(base_dir), index_col="id")
         train_df = train_df.join(depths_df)
         test_df = depths_df[~depths_df.index.isin(train_df.index)].copy()
 
-        test_df["images"] = load_images("{}/test/images".format(base_dir), test_df.index)
+        test_cache = DataCache(
+            base_dir, "test", depths_df, with_masks=False, cache_dir=cache_dir, decode_workers=decode_workers)
+        test_df["images"] = test_cache.select_images(test_df.index)
 
         self.df = test_df
 
 
+class DataCache:
+    """
+    Packed on-disk copy of the decoded PNGs of a split ("train" or "test"): one contiguous uint8 array for the
+    images, one for the masks and an id/depth index. The cache is built on first use, rebuilt whenever a source
+    PNG is newer than the index or the set of ids changed, and memory-mapped otherwise.
+    """
+
+    def __init__(self, base_dir, split, depths_df, with_masks, cache_dir=None, decode_workers=None):
+        if cache_dir is None:
+            cache_dir = "{}/cache".format(base_dir)
+
+        images_dir = "{}/{}/images".format(base_dir, split)
+        masks_dir = "{}/{}/masks".format(base_dir, split)
+        images_file_path = "{}/{}-images.npy".format(cache_dir, split)
+        masks_file_path = "{}/{}-masks.npy".format(cache_dir, split)
+        index_file_path = "{}/{}-index.csv".format(cache_dir, split)
+
+        ids = sorted(os.path.splitext(f)[0] for f in os.listdir(images_dir) if f.endswith(".png"))
+        source_dirs = [images_dir, masks_dir] if with_masks else [images_dir]
+        cache_file_paths = [images_file_path, masks_file_path] if with_masks else [images_file_path]
+
+        if not is_cache_valid(index_file_path, cache_file_paths, source_dirs, ids):
+            os.makedirs(cache_dir, exist_ok=True)
+            write_cache_array(images_file_path, load_images(images_dir, ids, decode_workers))
+            if with_masks:
+                write_cache_array(masks_file_path, load_masks(masks_dir, ids, decode_workers))
+            index_df = pd.DataFrame({"id": ids, "z": depths_df.z.reindex(ids).values})
+            index_df.to_csv(index_file_path + ".tmp", index=False)
+            os.replace(index_file_path + ".tmp", index_file_path)
+            print("cached {} {} images in '{}'".format(len(ids), split, cache_dir))
+
+        self.df = pd.read_csv(index_file_path, index_col="id", dtype={"id": str})
+        self.df["position"] = np.arange(len(self.df))
+        self.images = np.load(images_file_path, mmap_mode="r")
+        self.masks = np.load(masks_file_path, mmap_mode="r") if with_masks else None
+
+    def select_images(self, ids):
+        return list(self.images[self.df.position[ids].values])
+
+    def select_masks(self, ids):
+        return list(self.masks[self.df.position[ids].values])
+
+
+def is_cache_valid(index_file_path, cache_file_paths, source_dirs, ids):
+    if not all(os.path.isfile(p) for p in [index_file_path] + cache_file_paths):
+        return False
+
+    cached_ids = pd.read_csv(index_file_path, usecols=["id"], dtype={"id": str}).id.tolist()
+    if cached_ids != ids:
+        return False
+
+    cache_mtime = os.path.getmtime(index_file_path)
+    for source_dir in source_dirs:
+        for id in ids:
+            if os.path.getmtime("{}/{}.png".format(source_dir, id)) > cache_mtime:
+                return False
+
+    cache_shapes = [np.load(p, mmap_mode="r").shape for p in cache_file_paths]
+    return all(len(shape) == 3 and shape[0] == len(ids) for shape in cache_shapes)
+
+
+def write_cache_array(file_path, arrays):
+    cache_array = np.lib.format.open_memmap(
+        file_path + ".tmp", mode="w+", dtype=np.uint8, shape=(len(arrays),) + arrays[0].shape)
+    for i, array in enumerate(arrays):
+        cache_array[i] = array
+    cache_array.flush()
+    del cache_array
+    os.replace(file_path + ".tmp", file_path)
+
+
 class TrainDataset(Dataset):
-    def __init__(self, df, image_size_target, augment, train_set_scale_factor, pseudo_mask_weight_scale_factor):
+    def __init__(self, df, image_size_target, augment, train_set_scale_factor, pseudo_mask_weight_scale_factor,
+                 elastic_field_bank_size=0, raw=False, collate_mask_weights=False):
         super().__init__()
-        self.df = df
+        # the samples are kept as stacked arrays in shared memory, so that the data loader workers attach to them
+        # instead of getting their own copy of the data frame and its object columns
+        self.images = to_shared_tensor(df.images.values, np.uint8)
+        self.masks = to_shared_tensor(df.masks.values, np.uint8)
+        self.coverage_classes = df.coverage_class.values.astype(np.int8)
+        self.pseudo_masked = df.pseudo_masked.values.astype(np.bool_)
         self.image_size_target = image_size_target
         self.augment = augment
         self.train_set_scale_factor = train_set_scale_factor
         self.pseudo_mask_weight_scale_factor = pseudo_mask_weight_scale_factor
+        self.elastic_field_bank_size = elastic_field_bank_size
+        # raw samples are the unmodified image and mask, which are augmented, weighted, padded and normalized as a
+        # batch by batch_transforms.BatchTransform after collation
+        self.raw = raw
+        # the mask weights of a batch are calculated at once by collate
+        self.collate_mask_weights = collate_mask_weights
 
     def __len__(self):
-        return int(self.train_set_scale_factor * len(self.df))
+        return int(self.train_set_scale_factor * len(self.images))
 
     def __getitem__(self, index):
-        image = self.df.images[index % len(self.df)]
-        mask = self.df.masks[index % len(self.df)]
-        coverage_class = self.df.coverage_class[index % len(self.df)]
-        pseudo_masked = self.df.pseudo_masked[index % len(self.df)]
+        index = index % len(self.images)
+        image = self.images[index].numpy()
+        mask = self.masks[index].numpy()
+        coverage_class = self.coverage_classes[index]
+        pseudo_masked = self.pseudo_masked[index]
+        has_salt = torch.tensor(0.0 if coverage_class == 0 else 1.0).float()
 
-        if self.augment:
-            image, mask = augment(image, mask)
+        if self.raw:
+            mask_weight_factor = self.pseudo_mask_weight_scale_factor if pseudo_masked else 1.0
+            return self.images[index].unsqueeze(0), self.masks[index].unsqueeze(0), \
+                   torch.tensor(mask_weight_factor).float(), has_salt
 
-        mask_weights = calculate_mask_weights(mask)
-        if pseudo_masked:
-            mask_weights *= self.pseudo_mask_weight_scale_factor
+        if self.augment:
+            image, mask = augment(image, mask, self.elastic_field_bank_size)
 
-        if image.shape[1] < self.image_size_target:
-            image = upsample(image, self.image_size_target)
-            mask = upsample(mask, self.image_size_target)
-            mask_weights = upsample(mask_weights, self.image_size_target)
+        if self.collate_mask_weights:
+            mask_weight_factor = self.pseudo_mask_weight_scale_factor if pseudo_masked else 1.0
+            mask_weights = torch.tensor(mask_weight_factor).float()
         else:
-            image = cv2.resize(image, (self.image_size_target, self.image_size_target))
-            mask = cv2.resize(mask, (self.image_size_target, self.image_size_target))
-            mask_weights = cv2.resize(mask_weights, (self.image_size_target, self.image_size_target))
+            mask_weights = calculate_mask_weights(mask)
+            if pseudo_masked:
+                mask_weights *= self.pseudo_mask_weight_scale_factor
+            mask_weights = mask_to_tensor(mask_weights)
 
         image = image_to_tensor(image)
         mask = mask_to_tensor(mask)
-        mask_weights = mask_to_tensor(mask_weights)
-        has_salt = torch.tensor(0.0 if coverage_class == 0 else 1.0).float()
 
         image_mean = 0.4719
         image_std = 0.1610
 
-        image = normalize(image, (image_mean, image_mean, image_mean), (image_std, image_std, image_std))
+        image = normalize(image, (image_mean,), (image_std,))
 
         return image, mask, mask_weights, has_salt
 
+    def collate(self, samples):
+        """
+        Collates the samples and pads or resizes the batch to the target size at once, which makes it the required
+        collate_fn unless the samples are raw. With collate_mask_weights the mask weights of the batch are
+        calculated here as well, from the mask weight factors of the samples.
+        """
+        batch = default_collate(samples)
+        if self.raw:
+            return batch
+
+        images, masks, mask_weights, has_salt = batch
+
+        if self.collate_mask_weights:
+            mask_weight_factors = mask_weights
+            mask_weights = calculate_mask_weights_batch(masks.numpy()[:, 0].astype(np.uint8))
+            mask_weights *= mask_weight_factors.numpy().reshape(-1, 1, 1)
+            mask_weights = torch.from_numpy(mask_weights).unsqueeze(1)
+
+        images = resize_batch(images, self.image_size_target)
+        masks = resize_batch(masks, self.image_size_target)
+        mask_weights = resize_batch(mask_weights, self.image_size_target)
+
+        return images, masks, mask_weights, has_salt
+
 
 class TestDataset(Dataset):
-    def __init__(self, df, image_size_target):
+    """
+    The images of a data frame as unpadded, normalized tensors, evaluate.predict pads and crops them per batch.
+    """
+
+    def __init__(self, df):
         super().__init__()
-        self.df = df
-        self.image_size_target = image_size_target
+        self.images = to_shared_tensor(df.images.values, np.uint8)
 
     def __len__(self):
-        return len(self.df)
+        return len(self.images)
 
     def __getitem__(self, index):
-        image = self.df.images[index]
-        image = upsample(image, self.image_size_target)
-        image = image_to_tensor(image)
+        image = image_to_tensor(self.images[index].numpy())
 
         image_mean = 0.4719
         image_std = 0.1610
 
-        image = normalize(image, (image_mean, image_mean, image_mean), (image_std, image_std, image_std))
+        image = normalize(image, (image_mean,), (image_std,))
 
         return image
 
 
-def load_images(path, ids):
-    return [load_image(path, id) for id in ids]
+def to_shared_tensor(arrays, dtype):
+    if len(arrays) == 0:
+        return torch.from_numpy(np.zeros(0, dtype=dtype))
+    return torch.from_numpy(np.stack(arrays).astype(dtype, copy=False)).share_memory_()
+
+
+def decode_files(load_function, path, ids, num_workers=None):
+    """
+    Decodes the files of the given ids with a thread pool and returns the results in the order of the ids.
+    OpenCV releases the GIL while decoding, so the threads scale with the number of cores.
+    """
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+        results = list(executor.map(partial(load_function, path), ids))
+    duration = max(time.time() - start_time, 1e-6)
+    print("decoded %d files from '%s' in %.1fs (%.0f files/s)" % (
+        len(results), path, duration, len(results) / duration))
+    return results
+
+
+def load_images(path, ids, num_workers=None):
+    return decode_files(load_image, path, ids, num_workers)
 
 
 def load_image(path, id):
-    image = cv2.imread("{}/{}.png".format(path, id))
-    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return cv2.imread("{}/{}.png".format(path, id), cv2.IMREAD_GRAYSCALE)
 
 
-def load_masks(path, ids):
-    return [load_mask(path, id) for id in ids]
+def load_masks(path, ids, num_workers=None):
+    return decode_files(load_mask, path, ids, num_workers)
 
 
 def load_mask(path, id):
@@ -229,14 +379,24 @@ def load_mask(path, id):
     return (mask > 0).astype(np.uint8)
 
 
-def load_glcm_features(path, feature_name, ids):
-    return [load_glcm_feature(path, feature_name, id) for id in ids]
+def load_glcm_features(store_dir, split, feature_name, ids):
+    """
+    Reads a GLCM feature of the given images from the feature store of a split built by glcm.py and blends its
+    left and upper nearest neighbor variants.
+    """
+    index_df = pd.read_csv("{}/{}-glcm-index.csv".format(store_dir, split), index_col="id", dtype={"id": str})
+    features = np.load("{}/{}-glcm.npy".format(store_dir, split), mmap_mode="r")
 
+    positions = index_df.index.get_indexer(ids)
+    if np.any(positions < 0) or not np.all(index_df.done.values[positions]):
+        raise Exception("GLCM feature store of split '{}' misses some of the requested ids".format(split))
 
-def load_glcm_feature(path, feature_name, id):
-    feature_0 = cv2.imread("{}/{}-0/{}.png".format(path, feature_name, id), 0)
-    feature_90 = cv2.imread("{}/{}-90/{}.png".format(path, feature_name, id), 0)
-    return cv2.addWeighted(feature_0, 0.5, feature_90, 0.5, 0)
+    channel_0, channel_90 = glcm_feature_channels[feature_name]
+    feature_0 = np.ascontiguousarray(features[positions, :, :, channel_0])
+    feature_90 = np.ascontiguousarray(features[positions, :, :, channel_90])
+    blended = cv2.addWeighted(feature_0.reshape(-1, feature_0.shape[-1]), 0.5,
+                              feature_90.reshape(-1, feature_90.shape[-1]), 0.5, 0)
+    return list(blended.reshape(feature_0.shape))
 
 
 def prepare_image(image, image_size_target):
@@ -255,26 +415,34 @@ def calculate_coverage_class(mask):
 
 
 def image_to_tensor(image):
-    return torch.from_numpy((np.moveaxis(image, -1, 0) / 255).copy()).float()
+    return torch.from_numpy(np.expand_dims(image / 255, 0)).float()
 
 
 def mask_to_tensor(mask):
     return torch.from_numpy(np.expand_dims(mask, 0).copy()).float()
 
 
-def set_depth_channels(image, depth):
+def set_depth_channels(images, depths):
+    """
+    Replaces the 2nd channel of an image (H, W, 3) or a batch of images (N, H, W, 3) by the depth of every row and
+    the 3rd channel by the 1st channel scaled with the relative row position.
+    """
     max_depth = 1010
-    image = image.copy()
-    h, w, _ = image.shape
-    for row, const in enumerate(np.linspace(0, 1, h)):
-        image[row, :, 1] = int(np.round(255 * (depth - 50 + row) / max_depth))
-        image[row, :, 2] = np.round(const * image[row, :, 0]).astype(image.dtype)
-    return image
+    images = images.copy()
+    h = images.shape[-3]
+    rows = np.arange(h).reshape(-1, 1)
+    depths = np.asarray(depths, dtype=np.float64)[..., np.newaxis, np.newaxis]
+    images[..., 1] = np.round(255 * (depths - 50 + rows) / max_depth)
+    images[..., 2] = np.round(np.linspace(0, 1, h).reshape(-1, 1) * images[..., 0])
+    return images
 
 
 def add_depth_channels(image_tensor):
-    _, h, w = image_tensor.size()
-    for row, const in enumerate(np.linspace(0, 1, h)):
-        image_tensor[1, row, :] = const
-    image_tensor[2] = image_tensor[0] * image_tensor[1]
+    """
+    Sets the 2nd channel of an image tensor (3, H, W) or a batch of image tensors (N, 3, H, W) to the relative row
+    position and the 3rd channel to the product of the first two channels.
+    """
+    h = image_tensor.size(-2)
+    image_tensor[..., 1, :, :] = torch.from_numpy(np.linspace(0, 1, h)).view(h, 1).to(image_tensor)
+    image_tensor[..., 2, :, :] = image_tensor[..., 0, :, :] * image_tensor[..., 1, :, :]
     return image_tensor
@@ -1,15 +1,87 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 import torch
 from torch import nn
 
+from salt_classifier import split_model_output
+
 
 class Ensemble(nn.Module):
-    def __init__(self, models):
+    """
+    Averages the mask probabilities of its models, weighted by weights if given. The probabilities are accumulated
+    model by model, so at most one model output is kept alive besides the sum.
+    With member_workers > 1 the models run concurrently in a pool of that many threads, which is created on the first
+    forward pass and kept until close. The intra-op thread count of torch is a process wide setting, so while the pool
+    is open it is divided by the number of workers, and close restores it. The outputs are still accumulated in the
+    order of the models, so the result is the same as the one of the sequential execution.
+    """
+
+    def __init__(self, models, weights=None, member_workers=1):
         super().__init__()
-        self.models = models
+        self.models = nn.ModuleList(models)
+        # the mask predictions of the models are averaged uniformly without weights
+        self.weights = weights
+        self.member_workers = member_workers
+        self.executor = None
+        self.num_threads = None
 
     def forward(self, x):
-        all_prediction_logits = [m(x) for m in self.models]
-        sum_mask_predictions = torch.zeros_like(all_prediction_logits[0])
-        for prediction_logits in all_prediction_logits:
-            sum_mask_predictions += torch.sigmoid(prediction_logits)
-        return sum_mask_predictions / len(self.models)
+        if self.member_workers > 1 and len(self.models) > 1:
+            all_mask_predictions = self.concurrent_member_mask_predictions(x)
+        else:
+            all_mask_predictions = (member_mask_predictions(m, x) for m in self.models)
+
+        weights = self.weights
+        sum_mask_predictions = None
+        for i, mask_predictions in enumerate(all_mask_predictions):
+            if weights is not None:
+                mask_predictions = weights[i] * mask_predictions
+            if sum_mask_predictions is None:
+                sum_mask_predictions = mask_predictions
+            else:
+                sum_mask_predictions += mask_predictions
+        return sum_mask_predictions / (len(self.models) if weights is None else sum(weights))
+
+    def concurrent_member_mask_predictions(self, x):
+        executor = self.member_executor()
+        grad_enabled = torch.is_grad_enabled()
+
+        def predict(model):
+            # the grad mode is a setting of the calling thread
+            with torch.set_grad_enabled(grad_enabled):
+                return member_mask_predictions(model, x)
+
+        models = iter(self.models)
+        # at most member_workers models are submitted ahead, so their outputs are not all kept alive
+        pending = deque(executor.submit(predict, m) for m in islice(models, self.member_workers))
+        while len(pending) > 0:
+            mask_predictions = pending.popleft().result()
+            for m in islice(models, 1):
+                pending.append(executor.submit(predict, m))
+            yield mask_predictions
+
+    def member_executor(self):
+        if self.executor is None:
+            worker_count = min(self.member_workers, len(self.models))
+            self.num_threads = torch.get_num_threads()
+            torch.set_num_threads(max(1, self.num_threads // worker_count))
+            self.executor = ThreadPoolExecutor(max_workers=worker_count)
+        return self.executor
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            torch.set_num_threads(self.num_threads)
+
+    def __del__(self):
+        self.close()
+
+
+def member_mask_predictions(model, x):
+    # an ensemble member which is an ensemble itself already predicts probabilities
+    if isinstance(model, Ensemble):
+        return model(x)
+    return torch.sigmoid(split_model_output(model(x))[0])
@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+from metrics import precision_per_threshold
+
+
+def stack_predictions(all_predictions, count, file_path=None):
+    """
+    Stacks the validation probabilities of count models, given by an iterable, into one (M, N, H, W) float16 array,
+    written to a memmap at file_path if given, so that only the probabilities of one model are in memory at a time.
+    """
+    if file_path is None:
+        return np.stack(list(all_predictions)).astype(np.float16)
+
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    stacked = None
+    for i, predictions in enumerate(all_predictions):
+        if stacked is None:
+            stacked = np.lib.format.open_memmap(
+                file_path + ".tmp", mode="w+", dtype=np.float16, shape=(count,) + np.shape(predictions))
+        stacked[i] = predictions
+    stacked.flush()
+    del stacked
+    os.replace(file_path + ".tmp", file_path)
+    return np.load(file_path, mmap_mode="r")
+
+
+def ensemble_score(predictions, masks, thresholds=np.linspace(0, 1, 51)):
+    # the mean precision at the best binarization threshold, as chosen by evaluate.analyze
+    return np.max(np.mean(precision_per_threshold(predictions, masks, thresholds), axis=0))
+
+
+def greedy_ensemble_selection(stacked_predictions, masks, max_size, target_score=None,
+                              thresholds=np.linspace(0, 1, 51)):
+    """
+    Selects an ensemble by greedy forward selection with replacement (Caruana et al., "Ensemble Selection from
+    Libraries of Models", 2004) on stacked validation probabilities (M, N, H, W) of M models: each step adds the
+    model whose addition to the average of the selected models scores best.
+    The selection stops as soon as target_score is reached, otherwise after max_size steps, and the best scoring
+    prefix is kept. Returns the indices of the selected models, their weights, i.e. the share of the steps they
+    were selected in, and the score of the ensemble.
+    """
+    masks = np.asarray(masks)
+    prediction_sum = np.zeros(stacked_predictions.shape[1:], dtype=np.float32)
+    selection = []
+    best_selection, best_score = [], -np.inf
+
+    for step in range(max_size):
+        step_scores = [
+            ensemble_score((prediction_sum + stacked_predictions[m]) / (step + 1), masks, thresholds)
+            for m in range(len(stacked_predictions))]
+        best_model_index = int(np.argmax(step_scores))
+
+        prediction_sum += stacked_predictions[best_model_index]
+        selection.append(best_model_index)
+        print("ensemble selection step %d: model %d, score=%.4f" % (
+            step, best_model_index, step_scores[best_model_index]))
+
+        if step_scores[best_model_index] > best_score:
+            best_selection, best_score = list(selection), step_scores[best_model_index]
+        if target_score is not None and best_score >= target_score:
+            break
+
+    model_indices = sorted(set(best_selection))
+    weights = [best_selection.count(m) / len(best_selection) for m in model_indices]
+    return model_indices, weights, float(best_score)
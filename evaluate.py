@@ -5,10 +5,11 @@ import torch
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
 
+from batch_transforms import crop_batch, pad_batch
 from dataset import calculate_coverage_class, TestDataset
-from metrics import precision
+from metrics import precision_batch_numpy, precision_per_threshold
+from prediction_cache import image_hash
 from processing import crf_batch, postprocess_mask
-from transforms import downsample
 
 image_size_original = 101
 image_size_target = 128
@@ -32,7 +33,7 @@ def predict(model, data_loader, use_tta):
     val_predictions = []
     with torch.no_grad():
         for image in data_loader:
-            image = image.to(device)
+            image = pad_batch(image.to(device), image_size_target)
 
             if use_tta:
                 predictions1 = model(image)
@@ -42,46 +43,76 @@ def predict(model, data_loader, use_tta):
             else:
                 predictions = model(image)
 
-            val_predictions += [p for p in predictions.cpu().numpy()]
-    val_predictions = np.asarray(val_predictions).reshape(-1, image_size_target, image_size_target)
-    val_predictions = [downsample(p, image_size_original) for p in val_predictions]
-    return val_predictions
+            val_predictions.append(crop_batch(predictions, image_size_original).cpu().numpy())
+    val_predictions = np.concatenate(val_predictions).reshape(-1, image_size_original, image_size_original)
+    return list(val_predictions)
 
 
 def calculate_best_threshold(df):
     thresholds = np.linspace(0, 1, 51)
-    precisions_per_threshold = []
-    for threshold in thresholds:
-        precisions = []
-        for idx in df.index:
-            mask = df.loc[idx].masks
-            prediction = df.loc[idx].predictions
-            prediction_mask = np.int32(prediction > threshold)
-            precisions.append(precision(prediction_mask, mask))
-        precisions_per_threshold.append(np.mean(precisions))
+    precisions_per_threshold = calculate_precisions_per_threshold(df, thresholds)
     return thresholds[np.argmax(precisions_per_threshold)]
 
 
+def calculate_precisions_per_threshold(df, thresholds):
+    predictions = np.stack(df.predictions.values)
+    masks = np.stack(df.masks.values)
+    return np.mean(precision_per_threshold(predictions, masks, thresholds), axis=0)
+
+
 def calculate_predictions_cc(df, threshold):
     df["predictions_cc"] = [calculate_coverage_class(np.int32(p > threshold)) for p in df.predictions]
 
 
-def calculate_predictions(df, model, use_tta):
-    data_set = TestDataset(df, image_size_target)
+def calculate_predictions(df, model, use_tta, prediction_cache=None):
+    if prediction_cache is None:
+        df["predictions"] = predict_images(df, model, use_tta)
+        return
+
+    # only the first image of each content hash missing in the cache is predicted
+    image_hashes = [image_hash(image) for image in df.images]
+    predictions = [prediction_cache.lookup(image, h) for image, h in zip(df.images, image_hashes)]
+    missing_positions = {}
+    for position, (prediction, h) in enumerate(zip(predictions, image_hashes)):
+        if prediction is None:
+            missing_positions.setdefault(h, position)
+
+    print("%s, %d unique images to predict" % (prediction_cache.summary(), len(missing_positions)))
+
+    if len(missing_positions) > 0:
+        missing_df = df.iloc[list(missing_positions.values())]
+        for h, prediction in zip(missing_positions.keys(), predict_images(missing_df, model, use_tta)):
+            prediction_cache.store(h, prediction)
+        prediction_cache.save()
+
+    df["predictions"] = [
+        p if p is not None else prediction_cache.prediction(h) for p, h in zip(predictions, image_hashes)]
+
+
+def predict_images(df, model, use_tta):
+    data_set = TestDataset(df)
     data_loader = DataLoader(data_set, batch_size=batch_size, shuffle=False, num_workers=4)
-    df["predictions"] = predict(model, data_loader, use_tta)
+    return predict(model, data_loader, use_tta)
 
 
 def calculate_prediction_masks(df, threshold):
     df["prediction_masks"] = [np.int32(p > threshold) for p in df.predictions]
     df["prediction_masks_otsu"] = [np.int32(compute_otsu_mask(p)) for p in df.predictions]
-    df["prediction_masks_crf"] = crf_batch(df.images, df.prediction_masks)
+
+    # the tiles predicted empty by the salt classifiers of all models, whose prediction is exactly 0, are not refined
+    prediction_masks_crf = list(df.prediction_masks)
+    non_empty = np.array([p.max() > 0 for p in df.predictions], dtype=np.bool_)
+    refined_masks = crf_batch(df.images[non_empty], df.prediction_masks[non_empty])
+    for position, refined_mask in zip(np.flatnonzero(non_empty), refined_masks):
+        prediction_masks_crf[position] = refined_mask
+    df["prediction_masks_crf"] = prediction_masks_crf
 
 
 def calculate_precisions(df):
-    df["precisions"] = [precision(pm, m) for pm, m in zip(df.prediction_masks, df.masks)]
-    df["precisions_otsu"] = [precision(pm, m) for pm, m in zip(df.prediction_masks_otsu, df.masks)]
-    df["precisions_crf"] = [precision(pm, m) for pm, m in zip(df.prediction_masks_crf, df.masks)]
+    masks = np.stack(df.masks.values)
+    df["precisions"] = precision_batch_numpy(np.stack(df.prediction_masks.values), masks)
+    df["precisions_otsu"] = precision_batch_numpy(np.stack(df.prediction_masks_otsu.values), masks)
+    df["precisions_crf"] = precision_batch_numpy(np.stack(df.prediction_masks_crf.values), masks)
 
 
 def calculate_best_mask_per_cc(df):
@@ -106,27 +137,34 @@ def calculate_best_mask_per_cc(df):
 
 def calculate_best_prediction_masks(df, best_mask_per_cc):
     df["prediction_masks_best"] = [calculate_best_prediction_mask(df, idx, best_mask_per_cc) for idx in df.index]
-    df["prediction_masks_best_pp"] = [postprocess_mask(m) for m in df.prediction_masks_best]
+    # post-processing leaves empty masks unchanged
+    df["prediction_masks_best_pp"] = [postprocess_mask(m) if m.max() > 0 else m for m in df.prediction_masks_best]
 
 
 def calculate_best_precisions(df):
-    df["precisions_best"] = [precision(pm, m) for pm, m in zip(df.prediction_masks_best, df.masks)]
-    df["precisions_best_pp"] = [precision(pm, m) for pm, m in zip(df.prediction_masks_best_pp, df.masks)]
+    masks = np.stack(df.masks.values)
+    df["precisions_best"] = precision_batch_numpy(np.stack(df.prediction_masks_best.values), masks)
+    df["precisions_best_pp"] = precision_batch_numpy(np.stack(df.prediction_masks_best_pp.values), masks)
 
 
 def calculate_best_prediction_mask(df, idx, best_mask_per_cc):
     if df.loc[idx].prediction_masks_crf.sum() == 0:
         return df.loc[idx].prediction_masks_crf
     else:
-        return df.loc[idx][best_mask_per_cc[df.loc[idx].predictions_cc]]
+        # coverage classes without predictions in the analyzed set have no best mask
+        return df.loc[idx][best_mask_per_cc.get(df.loc[idx].predictions_cc, "prediction_masks")]
 
 
-def analyze(model, df, use_tta):
+def analyze(model, df, use_tta, predictions=None):
     pd.set_option("display.max_rows", 500)
     pd.set_option("display.max_columns", 500)
     pd.set_option("display.width", 160)
 
-    calculate_predictions(df, model, use_tta)
+    # precalculated predictions of the model, e.g. the cached ones of load_ensemble_model, are used as they are
+    if predictions is None:
+        calculate_predictions(df, model, use_tta)
+    else:
+        df["predictions"] = predictions
 
     mask_threshold = calculate_best_threshold(df)
     calculate_predictions_cc(df, mask_threshold)
@@ -1,82 +1,103 @@
-from multiprocessing import Pool
+import argparse
+import os
 
-import cv2
 import numpy as np
 import pandas as pd
 import tqdm
-from skimage.feature import greycomatrix, greycoprops
-from skimage.io import imread
 
-
-def read_image(imgid):
-    fn = '../salt/input/train/images/{}.png'.format(imgid)
-    return imread(fn)[..., 0].astype(np.float32) / 255
-
-
-def read_mask(imgid):
-    fn = '../salt/input/train/masks/{}.png'.format(imgid)
-    return imread(fn).astype(np.uint8)
-
-
-def glcm_props(patch):
-    lf = []
-    # props = ['dissimilarity', 'contrast', 'homogeneity', 'energy', 'correlation']
-    props = ['dissimilarity', 'contrast', 'homogeneity', 'energy']
+from dataset import DataCache
+
+
+def pad_image(img, PAD=4):
+    W = img.shape[-1]
+    imgx = np.zeros(img.shape[:-2] + (W + PAD * 2, W + PAD * 2), dtype=img.dtype)
+    imgx[..., PAD:W + PAD, PAD:W + PAD] = img
+    imgx[..., :PAD, PAD:W + PAD] = img[..., PAD:0:-1, :]
+    imgx[..., -PAD:, PAD:W + PAD] = img[..., W - 1:-PAD - 1:-1, :]
+    imgx[..., :, :PAD] = imgx[..., :, PAD * 2:PAD:-1]
+    imgx[..., :, -PAD:] = imgx[..., :, W + PAD - 1:-PAD * 2 - 1:-1]
+    return imgx
+
+
+def window_sums(values, window_height, window_width):
+    # sums of all window_height x window_width windows over the last two axes using an integral image
+    integral = np.zeros(values.shape[:-2] + (values.shape[-2] + 1, values.shape[-1] + 1), dtype=np.float64)
+    integral[..., 1:, 1:] = values.cumsum(axis=-2).cumsum(axis=-1)
+    height = integral.shape[-2] - window_height
+    width = integral.shape[-1] - window_width
+    return integral[..., window_height:, window_width:] \
+           - integral[..., :height, window_width:] \
+           - integral[..., window_height:, :width] \
+           + integral[..., :height, :width]
+
+
+def glcm_window_props(first, second, window_height, window_width):
+    """
+    Calculates dissimilarity, contrast, homogeneity and energy of the symmetric normed GLCM of every window over the
+    grey level pairs (first, second) of one direction, where the window covers window_height x window_width pairs.
+    """
+    pair_count = window_height * window_width
+
+    differences = first.astype(np.float64) - second.astype(np.float64)
+    dissimilarity = window_sums(np.abs(differences), window_height, window_width) / pair_count
+    contrast = window_sums(differences ** 2, window_height, window_width) / pair_count
+    homogeneity = window_sums(1 / (1 + differences ** 2), window_height, window_width) / pair_count
+
+    # the sum of the squared GLCM entries counts the ordered pairs of pair positions within a window having the same
+    # unordered grey level pair, where a diagonal entry counts 4 times and an off-diagonal entry 2 times as it
+    # appears both as (i, j) and (j, i) in the symmetric GLCM
+    keys = np.minimum(first, second).astype(np.int32) * 256 + np.maximum(first, second)
+    weights = np.where(first == second, 4.0, 2.0)
+
+    height, width = keys.shape[-2:]
+    squared_sum = window_sums(weights, window_height, window_width)
+    for dy in range(window_height):
+        for dx in range(-window_width + 1, window_width):
+            if dy == 0 and dx <= 0:
+                continue
+            # the offsets -(dy, dx) contribute the same amount, which is accounted for by the factor 2
+            x0, x1 = max(0, -dx), max(0, dx)
+            equal = keys[..., :height - dy, x0:width - x1] == keys[..., dy:, x1:width - x0]
+            squared_sum += 2 * window_sums(equal * weights[..., :height - dy, x0:width - x1],
+                                           window_height - dy, window_width - abs(dx))
+    energy = np.sqrt(squared_sum) / (2 * pair_count)
+
+    return [dissimilarity, contrast, homogeneity, energy]
+
+
+def glcm_feature_batch(images, PAD=4):
+    """
+    Calculates the GLCM features of the 2 * PAD + 1 sized window around every pixel of a batch of images with the
+    shape (N, W, W) for the left and the upper nearest neighbor.
+    """
+    images1 = (images * 255).astype(np.uint8)
+    imagesx = pad_image(images1, PAD)
+    size = 2 * PAD + 1
 
     # left nearest neighbor
-    glcm = greycomatrix(patch, [1], [0], 256, symmetric=True, normed=True)
-    for f in props:
-        lf.append(greycoprops(glcm, f)[0, 0])
+    props = glcm_window_props(imagesx[..., :, :-1], imagesx[..., :, 1:], size, size - 1)
 
     # upper nearest neighbor
-    glcm = greycomatrix(patch, [1], [np.pi / 2], 256, symmetric=True, normed=True)
-    for f in props:
-        lf.append(greycoprops(glcm, f)[0, 0])
-
-    # for i in range(len(props)):
-    #     lf.append(0.5 * (lf[i] + lf[i + len(props)]))
-
-    return lf
-
-
-def patch_gen(img, PAD=4):
-    img1 = (img * 255).astype(np.uint8)
-
-    W = 101
-    imgx = np.zeros((101 + PAD * 2, 101 + PAD * 2), dtype=img1.dtype)
-    imgx[PAD:W + PAD, PAD:W + PAD] = img1
-    imgx[:PAD, PAD:W + PAD] = img1[PAD:0:-1, :]
-    imgx[-PAD:, PAD:W + PAD] = img1[W - 1:-PAD - 1:-1, :]
-    imgx[:, :PAD] = imgx[:, PAD * 2:PAD:-1]
-    imgx[:, -PAD:] = imgx[:, W + PAD - 1:-PAD * 2 - 1:-1]
-
-    xx, yy = np.meshgrid(np.arange(0, W), np.arange(0, W))
-    xx, yy = xx.flatten() + PAD, yy.flatten() + PAD
+    props += glcm_window_props(imagesx[..., :-1, :], imagesx[..., 1:, :], size - 1, size)
 
-    for x, y in zip(xx, yy):
-        patch = imgx[y - PAD:y + PAD + 1, x - PAD:x + PAD + 1]
-        yield patch
+    fimgs = np.stack(props, axis=-1).astype(np.float32)
+    fimgs[images.reshape(len(images), -1).sum(axis=1) == 0] = 0
+    return fimgs
 
 
 def glcm_feature(img, verbose=False):
-    W, NF, PAD = 101, 8, 4
+    return glcm_feature_batch(img[np.newaxis])[0]
 
-    if img.sum() == 0:
-        return np.zeros((W, W, NF), dtype=np.float32)
 
-    # l = []
-    # with Pool(3) as pool:
-    #     for p in tqdm.tqdm(pool.imap(glcm_props, patch_gen(img, PAD)), total=W * W, disable=not verbose):
-    #         l.append(p)
-    l = [glcm_props(p) for p in patch_gen(img, PAD)]
+def calculate_glcm_features(imgid, img, verbose=False):
+    return normalize_glcm_features(imgid, glcm_feature(img, verbose))
 
-    fimg = np.array(l, dtype=np.float32).reshape(101, 101, -1)
-    return fimg
 
+def calculate_glcm_features_batch(imgids, images):
+    return np.stack([normalize_glcm_features(imgid, fimg) for imgid, fimg in zip(imgids, glcm_feature_batch(images))])
 
-def calculate_glcm_features(imgid, img, verbose=False):
-    fimg = glcm_feature(img, verbose)
 
+def normalize_glcm_features(imgid, fimg):
     for i in range(8):
         minv = np.min(fimg[..., i])
         maxv = np.max(fimg[..., i])
@@ -89,31 +110,69 @@ def calculate_glcm_features(imgid, img, verbose=False):
     return fimg
 
 
-def calculate_and_save_glcm_features(imgid, verbose=False):
-    fimg = calculate_glcm_features(imgid, read_image(imgid), verbose)
+def build_glcm_feature_store(data_cache, store_dir, split, batch_size=32):
+    """
+    Calculates the normalized GLCM features of all images of a split into one (N, H, W, 8) uint8 array and an
+    id index with a done flag per image. The features are written batch by batch, so a run that got interrupted
+    resumes with the images which are not done yet.
+    """
+    features_file_path = "{}/{}-glcm.npy".format(store_dir, split)
+    index_file_path = "{}/{}-glcm-index.csv".format(store_dir, split)
+
+    ids = data_cache.df.index.tolist()
+
+    index_df = None
+    if os.path.isfile(features_file_path) and os.path.isfile(index_file_path):
+        index_df = pd.read_csv(index_file_path, dtype={"id": str})
+        if index_df.id.tolist() != ids:
+            index_df = None
 
-    cv2.imwrite("../salt/input/glcm/dissimilarity-0/{}.png".format(imgid), (255 * fimg[..., 0]).astype(np.uint8))
-    cv2.imwrite("../salt/input/glcm/dissimilarity-90/{}.png".format(imgid), (255 * fimg[..., 1]).astype(np.uint8))
+    if index_df is None:
+        os.makedirs(store_dir, exist_ok=True)
+        features = np.lib.format.open_memmap(
+            features_file_path, mode="w+", dtype=np.uint8, shape=data_cache.images.shape + (8,))
+        index_df = pd.DataFrame({"id": ids, "done": False})
+        write_glcm_index(index_df, index_file_path)
+    else:
+        features = np.load(features_file_path, mmap_mode="r+")
 
-    cv2.imwrite("../salt/input/glcm/contrast-0/{}.png".format(imgid), (255 * fimg[..., 2]).astype(np.uint8))
-    cv2.imwrite("../salt/input/glcm/contrast-90/{}.png".format(imgid), (255 * fimg[..., 3]).astype(np.uint8))
+    positions = np.flatnonzero(~index_df.done.values)
+    print("{} of {} {} images need GLCM features".format(len(positions), len(ids), split))
 
-    cv2.imwrite("../salt/input/glcm/homogeneity-0/{}.png".format(imgid), (255 * fimg[..., 4]).astype(np.uint8))
-    cv2.imwrite("../salt/input/glcm/homogeneity-90/{}.png".format(imgid), (255 * fimg[..., 5]).astype(np.uint8))
+    for batch_start in tqdm.tqdm(range(0, len(positions), batch_size)):
+        batch_positions = positions[batch_start:batch_start + batch_size]
+        images = data_cache.images[batch_positions].astype(np.float32) / 255
+        fimgs = calculate_glcm_features_batch([ids[p] for p in batch_positions], images)
+        features[batch_positions] = (255 * fimgs).astype(np.uint8)
+        features.flush()
 
-    cv2.imwrite("../salt/input/glcm/energy-0/{}.png".format(imgid), (255 * fimg[..., 6]).astype(np.uint8))
-    cv2.imwrite("../salt/input/glcm/energy-90/{}.png".format(imgid), (255 * fimg[..., 7]).astype(np.uint8))
+        index_df.loc[batch_positions, "done"] = True
+        write_glcm_index(index_df, index_file_path)
+
+
+def write_glcm_index(index_df, index_file_path):
+    index_df.to_csv(index_file_path + ".tmp", index=False)
+    os.replace(index_file_path + ".tmp", index_file_path)
 
 
 def main():
-    train_df = pd.read_csv("{}/train.csv".format("../salt/input"), index_col="id", usecols=[0])
-    depths_df = pd.read_csv("{}/depths.csv".format("../salt/input"), index_col="id")
-    train_df = train_df.join(depths_df)
+    args = argparser.parse_args()
+
+    input_dir = args.input_dir
+    store_dir = args.store_dir or "{}/glcm".format(input_dir)
 
-    with Pool(32) as pool:
-        for _ in tqdm.tqdm(pool.imap(calculate_and_save_glcm_features, train_df.index), total=len(train_df.index)):
-            pass
+    depths_df = pd.read_csv("{}/depths.csv".format(input_dir), index_col="id")
+
+    for split, with_masks in [("train", True), ("test", False)]:
+        data_cache = DataCache(input_dir, split, depths_df, with_masks, cache_dir=args.cache_dir)
+        build_glcm_feature_store(data_cache, store_dir, split, args.batch_size)
 
 
 if __name__ == "__main__":
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--input_dir", default="../salt/input")
+    argparser.add_argument("--store_dir")
+    argparser.add_argument("--cache_dir")
+    argparser.add_argument("--batch_size", default=32, type=int)
+
     main()
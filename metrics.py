@@ -1,4 +1,8 @@
 import numpy as np
+import torch
+
+iou_thresholds = np.arange(0.5, 1.0, 0.05)
+iou_thresholds_tensors = {}
 
 
 def precision(outputs, labels):
@@ -18,6 +22,78 @@ def precision(outputs, labels):
     return precision
 
 
+def precision_per_threshold(predictions, labels, thresholds, chunk_size=256):
+    """
+    Calculates the precision of every binarization threshold for a stack of (N, H, W) predictions at once,
+    which equals precision(np.int32(prediction > threshold), label) for each pair; returns a (N, T) array.
+    Each pixel is assigned to the bucket of thresholds it exceeds, and per image bucket histograms then yield
+    the intersection and union of all thresholds in a single pass over the pixels.
+    """
+    thresholds = np.asarray(thresholds)
+    result = np.zeros((len(predictions), len(thresholds)))
+    for chunk_start in range(0, len(predictions), chunk_size):
+        chunk_predictions = np.asarray(predictions[chunk_start:chunk_start + chunk_size])
+        chunk_labels = np.asarray(labels[chunk_start:chunk_start + chunk_size])
+        n = len(chunk_predictions)
+
+        # the prediction exceeds threshold k if and only if k is less than its bucket
+        buckets = np.searchsorted(thresholds, chunk_predictions.reshape(n, -1), side="left")
+        buckets += (len(thresholds) + 1) * np.arange(n)[:, None]
+        label_pixels = chunk_labels.reshape(n, -1) > 0
+
+        bucket_counts = np.bincount(buckets.ravel(), minlength=n * (len(thresholds) + 1)).reshape(n, -1)
+        bucket_label_counts = \
+            np.bincount(buckets[label_pixels], minlength=n * (len(thresholds) + 1)).reshape(n, -1)
+
+        prediction_counts = np.cumsum(bucket_counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        intersections = np.cumsum(bucket_label_counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+        unions = prediction_counts + label_pixels.sum(axis=1)[:, None] - intersections
+
+        result[chunk_start:chunk_start + n] = precision_from_counts(intersections, unions)
+
+    return result
+
+
+def precision_from_counts(intersections, unions):
+    ious = intersections / np.maximum(unions, 1).astype(np.float64)
+    precisions = (ious[..., None] > iou_thresholds).sum(axis=-1) / float(len(iou_thresholds))
+    return np.where(unions == 0, 1.0, precisions)
+
+
 def precision_batch(outputs, labels):
-    batch_size = labels.shape[0]
-    return [precision(outputs[batch], labels[batch]) for batch in range(batch_size)]
+    """
+    Calculates precision for every sample of a (B, 1, H, W) batch with tensor operations on the device of the
+    outputs, so no host synchronization is needed; returns a (B,) double tensor.
+    """
+    batch_size = labels.size(0)
+    predictions = outputs.round().view(batch_size, -1)
+    labels = labels.view(batch_size, -1)
+
+    intersections = (predictions * labels).sum(1).double()
+    unions = ((predictions + labels) > 0).float().sum(1).double()
+
+    thresholds = iou_thresholds_tensor(outputs.device)
+    ious = intersections / unions.clamp(min=1)
+    precisions = (ious.unsqueeze(1) > thresholds).double().sum(1) / len(iou_thresholds)
+
+    return torch.where(unions == 0, torch.ones_like(precisions), precisions)
+
+
+def precision_batch_numpy(outputs, labels):
+    """
+    NumPy version of precision_batch for (N, H, W) arrays; returns the (N,) precisions.
+    """
+    batch_size = len(labels)
+    predictions = np.asarray(outputs).round().reshape(batch_size, -1)
+    labels = np.asarray(labels).reshape(batch_size, -1)
+
+    intersections = (predictions * labels).sum(axis=1)
+    unions = ((predictions + labels) > 0).sum(axis=1)
+
+    return precision_from_counts(intersections, unions)
+
+
+def iou_thresholds_tensor(device):
+    if device not in iou_thresholds_tensors:
+        iou_thresholds_tensors[device] = torch.from_numpy(iou_thresholds).to(device)
+    return iou_thresholds_tensors[device]
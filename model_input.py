@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+from torch import nn
+
+
+class ModelInput(nn.Module):
+    """
+    Adapts the single channel image batches of the data pipeline to the input of the wrapped model.
+    The grayscale channel is expanded to the channel count of the model stem only here, so that the data loader
+    workers, the collation and the host to device copies carry a single channel.
+    With depth_channels the 2nd and 3rd channel are the relative row position and the image scaled by it, as built by
+    dataset.add_depth_channels, taken from a fixed buffer for the input size instead of being built per sample.
+    The state dict is the one of the wrapped model, so checkpoints stay interchangeable.
+    """
+
+    def __init__(self, model, channels=3, depth_channels=False, input_size=128):
+        super().__init__()
+        self.model = model
+        self.channels = channels
+        self.depth_channels = depth_channels
+        self.register_buffer("row_positions", row_positions(input_size))
+
+    def forward(self, x):
+        if self.depth_channels:
+            positions = self.row_positions
+            if positions.size(2) != x.size(2):
+                positions = row_positions(x.size(2)).to(x)
+            positions = positions.expand_as(x)
+            return self.model(torch.cat([x, positions, x * positions], dim=1))
+        return self.model(x.expand(-1, self.channels, -1, -1))
+
+    def state_dict(self, destination=None, prefix="", keep_vars=False):
+        return self.model.state_dict(destination=destination, prefix=prefix, keep_vars=keep_vars)
+
+    def load_state_dict(self, state_dict, strict=True):
+        return self.model.load_state_dict(state_dict, strict)
+
+
+def row_positions(size):
+    return torch.from_numpy(np.linspace(0, 1, size)).float().view(1, 1, size, 1)
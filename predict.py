@@ -1,6 +1,7 @@
 import datetime
 import time
 
+import numpy as np
 import torch.nn as nn
 from torch.utils.data import DataLoader
 
@@ -8,6 +9,7 @@ from dataset import TrainData, TrainDataset, TestData
 from ensemble import Ensemble
 from evaluate import analyze, calculate_predictions, calculate_predictions_cc, calculate_prediction_masks, \
     calculate_best_prediction_masks
+from prediction_cache import PredictionCache, model_fingerprint
 from train import load_ensemble_model
 from utils import write_submission
 
@@ -15,9 +17,15 @@ from utils import write_submission
 def main():
     input_dir = "/storage/kaggle/tgs"
     output_dir = "/artifacts"
+    cache_dir = None
+    prediction_cache_dir = "{}/prediction_cache".format(output_dir)
+    use_prediction_cache = False
+    # the prediction of the blank tiles without running the model, None to predict them as well
+    blank_prediction = None
     image_size_target = 128
     batch_size = 32
     ensemble_model_count = 3
+    ensemble_member_workers = 1
     fold_count = 5
     fold_index = 3
     use_parallel_model = True
@@ -42,7 +50,8 @@ def main():
         pseudo_labeling_submission_csv,
         pseudo_labeling_test_fold_count,
         pseudo_labeling_test_fold_index,
-        pseudo_labeling_extend_val_set)
+        pseudo_labeling_extend_val_set,
+        cache_dir=cache_dir)
 
     val_set = TrainDataset(
         train_data.val_set_df,
@@ -52,7 +61,8 @@ def main():
         pseudo_mask_weight_scale_factor=pseudo_labeling_loss_weight_factor)
 
     val_set_data_loader = \
-        DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=pin_memory)
+        DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=pin_memory,
+                   collate_fn=val_set.collate)
 
     eval_start_time = time.time()
 
@@ -60,28 +70,36 @@ def main():
     print("evaluation of the training model")
 
     models = []
+    models_val_predictions = []
 
-    _, ensemble_model = load_ensemble_model(
+    _, ensemble_model, val_predictions = load_ensemble_model(
         ensemble_model_count, "/storage/models/tgs/seresnext-hc-fold-3", val_set_data_loader,
         criterion, swa_enabled, "unet_seresnext50_hc",
-        image_size_target, use_parallel_model=use_parallel_model)
+        image_size_target, use_parallel_model=use_parallel_model,
+        val_df=train_data.val_set_df, prediction_cache_dir=prediction_cache_dir)
     models.append(ensemble_model)
+    models_val_predictions.append(val_predictions)
 
-    _, ensemble_model = load_ensemble_model(
+    _, ensemble_model, val_predictions = load_ensemble_model(
         ensemble_model_count, "/storage/models/tgs/seresnext101-hc-fold-3", val_set_data_loader,
         criterion, swa_enabled, "unet_seresnext101_hc",
-        image_size_target, use_parallel_model=use_parallel_model)
+        image_size_target, use_parallel_model=use_parallel_model,
+        val_df=train_data.val_set_df, prediction_cache_dir=prediction_cache_dir)
     models.append(ensemble_model)
+    models_val_predictions.append(val_predictions)
 
-    _, ensemble_model = load_ensemble_model(
+    _, ensemble_model, val_predictions = load_ensemble_model(
         ensemble_model_count, "/storage/models/tgs/senet", val_set_data_loader,
         criterion, swa_enabled, "unet_senet",
-        image_size_target, use_parallel_model=use_parallel_model)
+        image_size_target, use_parallel_model=use_parallel_model,
+        val_df=train_data.val_set_df, prediction_cache_dir=prediction_cache_dir)
     models.append(ensemble_model)
+    models_val_predictions.append(val_predictions)
 
-    ensemble_model = Ensemble(models)
+    ensemble_model = Ensemble(models, member_workers=ensemble_member_workers)
 
-    mask_threshold, best_mask_per_cc = analyze(ensemble_model, train_data.val_set_df, use_tta=True)
+    mask_threshold, best_mask_per_cc = analyze(
+        ensemble_model, train_data.val_set_df, use_tta=True, predictions=list(np.mean(models_val_predictions, axis=0)))
 
     eval_end_time = time.time()
     print()
@@ -92,8 +110,13 @@ def main():
 
     submission_start_time = time.time()
 
-    test_data = TestData(input_dir)
-    calculate_predictions(test_data.df, ensemble_model, use_tta=True)
+    test_data = TestData(input_dir, cache_dir=cache_dir)
+    prediction_cache = None
+    if use_prediction_cache:
+        prediction_cache = PredictionCache(
+            model_fingerprint(ensemble_model, use_tta=True), prediction_cache_dir, blank_prediction)
+    calculate_predictions(test_data.df, ensemble_model, use_tta=True, prediction_cache=prediction_cache)
+    ensemble_model.close()
     calculate_predictions_cc(test_data.df, mask_threshold)
     calculate_prediction_masks(test_data.df, mask_threshold)
     calculate_best_prediction_masks(test_data.df, best_mask_per_cc)
@@ -0,0 +1,175 @@
+import hashlib
+import os
+
+import numpy as np
+
+from ensemble import Ensemble
+from model_input import ModelInput
+
+
+class PredictionCache:
+    """
+    Predictions of one model by the content hash of the predicted image, so that duplicate images are predicted
+    once. The cache belongs to the model fingerprint it is created for and is persisted to a file per fingerprint
+    in cache_dir, if given.
+    Constant images, e.g. the all black tiles, are not predicted at all with blank_prediction set, their prediction
+    is an image filled with that value instead.
+    The predictions are kept as float16, so a prediction is the same whether it was just predicted or read from the
+    file, which is only rewritten if predictions were added.
+    """
+
+    def __init__(self, fingerprint, cache_dir=None, blank_prediction=None):
+        self.fingerprint = fingerprint
+        self.cache_dir = cache_dir
+        self.blank_prediction = blank_prediction
+        self.predictions = {}
+        self.stored = 0
+        self.hits = 0
+        self.blanks = 0
+        self.misses = 0
+
+        if self.file_path() is not None and os.path.isfile(self.file_path()):
+            with np.load(self.file_path()) as cache_file:
+                self.predictions = dict(zip(cache_file["hashes"], cache_file["predictions"]))
+            print("loaded %d cached predictions from '%s'" % (len(self.predictions), self.file_path()))
+
+    def file_path(self):
+        if self.cache_dir is None:
+            return None
+        return "{}/predictions-{}.npz".format(self.cache_dir, self.fingerprint)
+
+    def lookup(self, image, image_hash):
+        if self.blank_prediction is not None and image.min() == image.max():
+            self.blanks += 1
+            return np.full(image.shape, self.blank_prediction, dtype=np.float32)
+        if image_hash not in self.predictions:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.prediction(image_hash)
+
+    def prediction(self, image_hash):
+        return self.predictions[image_hash].astype(np.float32)
+
+    def store(self, image_hash, prediction):
+        self.predictions[image_hash] = prediction.astype(np.float16)
+        self.stored += 1
+
+    def save(self):
+        if self.file_path() is None or self.stored == 0:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        hashes = list(self.predictions.keys())
+        # np.savez appends the extension to file names without it
+        with open(self.file_path() + ".tmp", "wb") as cache_file:
+            np.savez(cache_file, hashes=np.array(hashes), predictions=np.stack([self.predictions[h] for h in hashes]))
+        os.replace(self.file_path() + ".tmp", self.file_path())
+        self.stored = 0
+
+    def summary(self):
+        return "prediction cache: %d hits, %d blank images, %d misses" % (self.hits, self.blanks, self.misses)
+
+
+class CheckpointPredictionCache:
+    """
+    The validation results of model checkpoints, i.e. the val loss and precision of train.evaluate and the TTA
+    probabilities of evaluate.predict as float16, by the content hash of the checkpoint file. The cache belongs to
+    the fingerprint of the validation set and the model configuration it is created for and is persisted to a file
+    per checkpoint in cache_dir, if given.
+    With cache_dir only the scores are kept in memory and the probabilities are read from the file when they are
+    needed, otherwise they are kept in memory as well.
+    """
+
+    def __init__(self, val_fingerprint, cache_dir=None):
+        self.val_fingerprint = val_fingerprint
+        self.cache_dir = cache_dir
+        self.scores = {}
+        self.predictions = {}
+
+    def file_path(self, checkpoint_hash):
+        if self.cache_dir is None:
+            return None
+        return "{}/checkpoint-{}-{}.npz".format(self.cache_dir, checkpoint_hash, self.val_fingerprint)
+
+    def load_scores(self, checkpoint_hash):
+        if checkpoint_hash not in self.scores:
+            file_path = self.file_path(checkpoint_hash)
+            if file_path is None or not os.path.isfile(file_path):
+                return None
+            # the members of the file are read lazily, so the probabilities are not read here
+            with np.load(file_path) as cache_file:
+                self.scores[checkpoint_hash] = float(cache_file["val_loss"]), float(cache_file["val_precision"])
+        return self.scores[checkpoint_hash]
+
+    def load_predictions(self, checkpoint_hash):
+        if checkpoint_hash in self.predictions:
+            return self.predictions[checkpoint_hash]
+        with np.load(self.file_path(checkpoint_hash)) as cache_file:
+            return cache_file["predictions"]
+
+    def store(self, checkpoint_hash, val_loss, val_precision, predictions):
+        predictions = np.stack(predictions).astype(np.float16)
+        self.scores[checkpoint_hash] = val_loss, val_precision
+
+        file_path = self.file_path(checkpoint_hash)
+        if file_path is None:
+            self.predictions[checkpoint_hash] = predictions
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(file_path + ".tmp", "wb") as cache_file:
+            np.savez(cache_file, val_loss=val_loss, val_precision=val_precision, predictions=predictions)
+        os.replace(file_path + ".tmp", file_path)
+
+
+def image_hash(image):
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1("{}{}".format(image.dtype, image.shape).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def model_fingerprint(model, use_tta):
+    """
+    Hashes the parameters and buffers of a model, or of all members of an ensemble together with their weights,
+    along with the use of TTA and the settings which are not part of the state: the empty thresholds of the salt
+    classifier gating and the channels built by ModelInput.
+    """
+    digest = hashlib.sha1("tta={}".format(use_tta).encode())
+    update_model_digest(digest, model)
+    return digest.hexdigest()
+
+
+def update_model_digest(digest, model):
+    if isinstance(model, Ensemble):
+        digest.update("ensemble weights={}".format(model.weights).encode())
+        for m in model.models:
+            update_model_digest(digest, m)
+        return
+
+    empty_thresholds = [module.empty_threshold for module in model.modules() if hasattr(module, "empty_threshold")]
+    digest.update("empty_thresholds={}".format(empty_thresholds).encode())
+    model_inputs = [(module.channels, module.depth_channels) for module in model.modules()
+                    if isinstance(module, ModelInput)]
+    digest.update("model_inputs={}".format(model_inputs).encode())
+    for name, value in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(value.detach().cpu().numpy().tobytes())
+
+
+def file_hash(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def val_set_fingerprint(df, *config):
+    """
+    Hashes the images and masks of a validation set together with the configuration its results depend on.
+    """
+    digest = hashlib.sha1("{}".format(config).encode())
+    for images in [df.images, df.masks]:
+        for image in images:
+            digest.update(np.ascontiguousarray(image).tobytes())
+    return digest.hexdigest()
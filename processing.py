@@ -19,15 +19,47 @@ def calculate_contour(mask, width=3):
     return np.int32(contour != 0)
 
 
+def calculate_contour_batch(masks, width=3):
+    """
+    Calculates the contours of calculate_contour for a batch of masks (N, H, W) with shifted sums instead of
+    convolutions. Every stage is cast to the dtype of the masks as the output of ndimage.convolve is, so that uint8
+    masks wrap around exactly as there.
+    """
+    dtype = masks.dtype
+
+    padded = pad_edges(masks.astype(np.int32))
+    row_sums = padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]
+    column_sums = padded[:, :, :-2] + padded[:, :, 1:-1] + padded[:, :, 2:]
+    edge_x = (row_sums[:, :, :-2] - row_sums[:, :, 2:]).astype(dtype)
+    edge_y = (column_sums[:, :-2] - column_sums[:, 2:]).astype(dtype)
+    contour = np.abs(edge_x) + np.abs(edge_y)
+
+    for _ in range(width - 1):
+        padded = pad_edges(contour.astype(np.int32))
+        row_sums = padded[:, :-2] + padded[:, 1:-1] + padded[:, 2:]
+        contour = (row_sums[:, :, :-2] + row_sums[:, :, 1:-1] + row_sums[:, :, 2:]).astype(dtype)
+
+    return np.int32(contour != 0)
+
+
+def pad_edges(masks):
+    # the 'reflect' mode of ndimage repeats the edge for a one pixel border
+    return np.pad(masks, ((0, 0), (1, 1), (1, 1)), mode="edge")
+
+
 def calculate_mask_weights(mask):
+    return calculate_mask_weights_batch(mask[np.newaxis])[0]
+
+
+def calculate_mask_weights_batch(masks):
     salt_mean = 0.247966
 
-    contour = calculate_contour(mask)
+    contours = calculate_contour_batch(masks)
 
-    weights = np.zeros_like(mask, np.float32)
-    weights[mask == 0] = salt_mean / (1.0 - salt_mean)
-    weights[mask == 1] = 1.0
-    weights[contour == 1] = 3.0
+    weights = np.zeros_like(masks, np.float32)
+    weights[masks == 0] = salt_mean / (1.0 - salt_mean)
+    weights[masks == 1] = 1.0
+    weights[contours == 1] = 3.0
 
     return weights
 
@@ -87,34 +119,46 @@ def rlenc(img, order='F', format=True):
 
     returns run length as an array or string (if format is True)
     """
-    bytes = img.reshape(img.shape[0] * img.shape[1], order=order)
-    runs = []  ## list of run lengths
-    r = 0  ## the current run length
-    pos = 1  ## count starts from 1 per WK
-    for c in bytes:
-        if (c == 0):
-            if r != 0:
-                runs.append((pos, r))
-                pos += r
-                r = 0
-            pos += 1
-        else:
-            r += 1
-
-    # if last run is unsaved (i.e. data ends with 1)
-    if r != 0:
-        runs.append((pos, r))
-        pos += r
-        r = 0
+    pixels = img.reshape(1, img.shape[0] * img.shape[1], order=order)
+    _, starts, lengths = calculate_runs(pixels)
 
     if format:
-        z = ''
-
-        for rr in runs:
-            z += '{} {} '.format(rr[0], rr[1])
-        return z[:-1]
+        return format_runs(starts, lengths)
     else:
-        return runs
+        return list(zip(starts.tolist(), lengths.tolist()))
+
+
+def rlenc_batch(masks):
+    """
+    Run-length encodes a stack of binary masks of shape (N, H, W) in one pass.
+    Returns one string per mask, formatted like rlenc(mask).
+    """
+    masks = np.asarray(masks)
+    pixels = masks.transpose(0, 2, 1).reshape(masks.shape[0], -1)
+    rows, starts, lengths = calculate_runs(pixels)
+    run_counts = np.bincount(rows, minlength=masks.shape[0])
+    run_ends = np.cumsum(run_counts)
+    return [format_runs(starts[e - c:e], lengths[e - c:e]) for c, e in zip(run_counts, run_ends)]
+
+
+def calculate_runs(pixels):
+    """
+    Finds the runs of non-zero values in each row of a (N, P) array.
+    Returns the row, the 1-based start position and the length of every run, ordered by row and position.
+    """
+    padded = np.zeros((pixels.shape[0], pixels.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = pixels != 0
+    changes = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(changes == 1)
+    _, ends = np.nonzero(changes == -1)
+    return rows, starts + 1, ends - starts
+
+
+def format_runs(starts, lengths):
+    runs = np.empty(2 * len(starts), dtype=np.int64)
+    runs[0::2] = starts
+    runs[1::2] = lengths
+    return " ".join(map(str, runs.tolist()))
 
 
 def rldec(rle_mask):
@@ -124,16 +168,33 @@ def rldec(rle_mask):
     Returns numpy array, 1 - mask, 0 - background
 
     '''
-    if rle_mask == "nan":
-        return np.zeros((101, 101))
-    s = rle_mask.split()
-    starts, lengths = [np.asarray(x, dtype=int) for x in (s[0:][::2], s[1:][::2])]
-    starts -= 1
-    ends = starts + lengths
-    img = np.zeros(101 * 101, dtype=np.uint8)
-    for lo, hi in zip(starts, ends):
-        img[lo:hi] = 1
-    return img.reshape(101, 101).transpose((1, 0))
+    return rldec_batch([rle_mask])[0]
+
+
+def rldec_batch(rle_masks, shape=(101, 101)):
+    """
+    Decodes a sequence of run-length strings into one preallocated (N, H, W) uint8 array.
+    As in rldec, the string "nan" (a missing CSV value) decodes to an empty mask.
+    """
+    height, width = shape
+    size = height * width
+
+    rle_masks = ["" if rle_mask == "nan" else rle_mask for rle_mask in rle_masks]
+    run_counts = np.array([len(rle_mask.split()) // 2 for rle_mask in rle_masks], dtype=np.int64)
+    runs = np.array(" ".join(rle_masks).split(), dtype=np.int64).reshape(-1, 2)
+
+    offsets = np.repeat(np.arange(len(rle_masks), dtype=np.int64) * size, run_counts)
+    starts = offsets + runs[:, 0] - 1
+    ends = starts + runs[:, 1]
+
+    # +1 at every run start and -1 at every run end, the cumulative sum then covers the runs;
+    # the runs of a valid encoding never share a start or an end, so plain fancy indexing suffices
+    changes = np.zeros(len(rle_masks) * size + 1, dtype=np.int8)
+    changes[starts] += 1
+    changes[ends] -= 1
+    masks = np.cumsum(changes[:-1], dtype=np.int8).view(np.uint8)
+
+    return np.ascontiguousarray(masks.reshape(len(rle_masks), width, height).transpose((0, 2, 1)))
 
 
 def postprocess_mask(mask):
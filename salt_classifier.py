@@ -0,0 +1,45 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# the mask logit of the tiles skipped as empty, whose sigmoid is exactly 0 in float32
+empty_mask_logit = -1e4
+
+
+class SaltClassifier(nn.Module):
+    """
+    Image level classification head predicting the logit of a tile containing salt from the encoder bottleneck.
+    """
+
+    def __init__(self, in_channels):
+        super().__init__()
+        self.fc = nn.Linear(in_channels, 1)
+
+    def forward(self, x):
+        return self.fc(F.adaptive_avg_pool2d(x, 1).view(x.size(0), -1)).view(-1)
+
+
+def decode_non_empty(decode, features, has_salt_logits, empty_threshold, output_size):
+    """
+    Runs decode on the features of the samples which are not predicted empty with a probability of at least
+    empty_threshold. The mask logits of the skipped samples are empty_mask_logit.
+    """
+    non_empty = (1 - torch.sigmoid(has_salt_logits)) < empty_threshold
+    if non_empty.all():
+        return decode(*features)
+
+    mask_logits = features[0].new_full((features[0].size(0),) + tuple(output_size), empty_mask_logit)
+    indices = non_empty.nonzero().view(-1)
+    if len(indices) > 0:
+        mask_logits[indices] = decode(*[f[indices] for f in features])
+    return mask_logits
+
+
+def split_model_output(output):
+    """
+    Splits a model output into the mask logits and the has salt logits, which are None for the models without a
+    salt classifier.
+    """
+    if isinstance(output, tuple):
+        return output
+    return output, None
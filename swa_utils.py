@@ -7,6 +7,30 @@ def moving_average(net1, net2, alpha=1):
         param1.data += param2.data * alpha
 
 
+def models_compatible(models):
+    # the models can be merged in weight space if their parameters and buffers match by name and shape
+    shapes = [[(name, tuple(value.size())) for name, value in m.state_dict().items()] for m in models]
+    return all(s == shapes[0] for s in shapes[1:])
+
+
+def merge_models(merged_model, models, weights=None):
+    """
+        Weighted average of the parameters of models with the same architecture.
+        The BatchNorm buffers are not averaged and have to be recalculated with bn_update.
+
+        :param merged_model: model the averaged parameters are written to.
+        :param models: models being merged
+        :param weights: weights of the models, uniform if None
+        :return: None
+    """
+    if weights is None:
+        weights = [1.0] * len(models)
+    weight_sum = 0.0
+    for model, weight in zip(models, weights):
+        weight_sum += weight
+        moving_average(merged_model, model, weight / weight_sum)
+
+
 def _check_bn(module, flag):
     if issubclass(module.__class__, torch.nn.modules.batchnorm._BatchNorm):
         flag[0] = True
@@ -49,9 +73,10 @@ def bn_update(loader, model):
     momenta = {}
     model.apply(reset_bn)
     model.apply(lambda module: _get_momenta(module, momenta))
+    device = next(model.parameters()).device
     n = 0
     for batch in loader:
-        input = batch[0].cuda(async=True)
+        input = batch[0].to(device, non_blocking=True)
         input_var = torch.autograd.Variable(input)
         b = input_var.data.size(0)
 
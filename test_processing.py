@@ -0,0 +1,20 @@
+import numpy as np
+
+from processing import rldec_batch, rlenc
+
+
+def test_rldec_batch_all_empty():
+    masks = rldec_batch(["nan", "nan"])
+    assert masks.shape == (2, 101, 101)
+    assert masks.dtype == np.uint8
+    assert masks.sum() == 0
+
+
+def test_rldec_batch_mixed():
+    mask = np.zeros((101, 101), dtype=np.uint8)
+    mask[10:20, 30:45] = 1
+    masks = rldec_batch(["nan", rlenc(mask), "nan"])
+    assert masks.shape == (3, 101, 101)
+    assert masks[0].sum() == 0
+    assert np.array_equal(masks[1], mask)
+    assert masks[2].sum() == 0
@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+class PhaseTimer:
+    """
+    Records the wall time of every execution of the named phases of a loop, e.g. data loading, forward and
+    backward pass, together with the number of processed samples.
+    Device kernels run asynchronously, so without synchronize the device work is attributed to the phase that
+    waits for it rather than to the phase that launched it; synchronize waits for the device at every phase
+    boundary, which gives exact attribution at the cost of pipelining.
+    """
+
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.durations = OrderedDict()
+        self.samples = 0
+
+    @contextmanager
+    def phase(self, name):
+        self.synchronize_device()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize_device()
+            self.durations.setdefault(name, []).append(time.perf_counter() - start_time)
+
+    def synchronize_device(self):
+        if self.synchronize and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def add_samples(self, count):
+        self.samples += count
+
+    def merge(self, other):
+        for name, durations in other.durations.items():
+            self.durations.setdefault(name, []).extend(durations)
+        self.samples += other.samples
+
+    def total(self, name):
+        return sum(self.durations.get(name, []))
+
+    def total_time(self):
+        return sum(sum(durations) for durations in self.durations.values())
+
+    def summary(self, title):
+        total_time = self.total_time()
+
+        lines = ["%-12s %8s %10s %7s %10s %10s %10s %10s" % (
+            title, "calls", "total_s", "share", "mean_ms", "p50_ms", "p90_ms", "p99_ms")]
+        for name, durations in self.durations.items():
+            durations_ms = 1000 * np.array(durations)
+            lines.append("%-12s %8d %10.1f %6.1f%% %10.2f %10.2f %10.2f %10.2f" % (
+                name,
+                len(durations_ms),
+                durations_ms.sum() / 1000,
+                100 * durations_ms.sum() / 1000 / max(total_time, 1e-9),
+                durations_ms.mean(),
+                np.percentile(durations_ms, 50),
+                np.percentile(durations_ms, 90),
+                np.percentile(durations_ms, 99)))
+
+        if self.samples > 0:
+            lines.append("samples: %d, samples/s: %.1f" % (self.samples, self.samples / max(total_time, 1e-9)))
+
+        return "\n".join(lines)
@@ -15,27 +15,38 @@ from tensorboardX import SummaryWriter
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from torch.utils.data import DataLoader
 
+from batch_transforms import BatchTransform
 from dataset import TrainData, TrainDataset, TestData
 from deeplab_resnet import DeepLabv3_plus
 from drn_unet import UNetDrn
 from ensemble import Ensemble
+from ensemble_selection import ensemble_score, greedy_ensemble_selection, stack_predictions
 from evaluate import analyze, calculate_predictions, calculate_prediction_masks, calculate_predictions_cc, \
-    calculate_best_prediction_masks
+    calculate_best_prediction_masks, predict_images
 from losses import LovaszLoss, RobustFocalLoss2d, SoftDiceLoss, BCELovaszLoss
 from metrics import precision_batch
+from model_input import ModelInput
+from prediction_cache import CheckpointPredictionCache, PredictionCache, file_hash, model_fingerprint, \
+    val_set_fingerprint
+from salt_classifier import split_model_output
 from models import UNetResNet
-from swa_utils import moving_average, bn_update
+from swa_utils import moving_average, bn_update, merge_models, models_compatible
+from timing import PhaseTimer
 from unet_hc import UNetResNetHc
 from unet_senet import UNetSeNet
 from unet_senet_hc import UNetSeNetHc
 from unet_senet_hc_cat import UNetSeNetHcCat
 from unet_senet_hc_ds import UNetSeNetHcDs
 from unet_senet_hc_scale import UNetSeNetHcScale
-from utils import get_learning_rate, write_submission
+from utils import get_learning_rate, write_submission, BufferedSummaryWriter
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 cudnn.benchmark = True
 
+train_phases = ["data", "transfer", "augment", "forward", "backward", "metric", "optimizer"]
+eval_phases = ["data", "transfer", "augment", "forward", "metric"]
+epoch_phases = ["evaluate", "checkpoint", "swa"]
+
 
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
@@ -46,11 +57,16 @@ def str2bool(v):
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
 
-def create_model(type, input_size, pretrained, parallel):
+def create_model(type, input_size, pretrained, parallel, depth_channels=False, salt_classifier=False,
+                 empty_threshold=None):
+    if salt_classifier and type not in ["unet_resnet_hc", "unet_seresnext50_hc", "unet_seresnext101_hc", "unet_senet_hc"]:
+        raise Exception("Unsupported model type for a salt classifier: '{}".format(type))
+
     if type == "unet_resnet":
         model = UNetResNet(1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
     elif type == "unet_resnet_hc":
-        model = UNetResNetHc(1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
+        model = UNetResNetHc(1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained,
+                             salt_classifier=salt_classifier, empty_threshold=empty_threshold)
     elif type == "unet_drn":
         model = UNetDrn(1, input_size, pretrained=pretrained)
     elif type == "unet_seresnet":
@@ -60,13 +76,16 @@ def create_model(type, input_size, pretrained, parallel):
     elif type == "unet_senet":
         model = UNetSeNet(backbone="senet154", num_classes=1, input_size=input_size, pretrained=pretrained)
     elif type == "unet_seresnext50_hc":
-        model = UNetSeNetHc("se_resnext50", 1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
+        model = UNetSeNetHc("se_resnext50", 1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained,
+                            salt_classifier=salt_classifier, empty_threshold=empty_threshold)
     elif type == "unet_seresnext50_hc_scale":
         model = UNetSeNetHcScale("se_resnext50", 1, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
     elif type == "unet_seresnext101_hc":
-        model = UNetSeNetHc("se_resnext101", 1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
+        model = UNetSeNetHc("se_resnext101", 1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained,
+                            salt_classifier=salt_classifier, empty_threshold=empty_threshold)
     elif type == "unet_senet_hc":
-        model = UNetSeNetHc("senet154", 1, input_size, num_filters=32, dropout_2d=0.5, pretrained=pretrained)
+        model = UNetSeNetHc("senet154", 1, input_size, num_filters=32, dropout_2d=0.5, pretrained=pretrained,
+                            salt_classifier=salt_classifier, empty_threshold=empty_threshold)
     elif type == "unet_seresnext_hc_cat":
         model = UNetSeNetHcCat("se_resnext50", 1, input_size, num_filters=32, dropout_2d=0.2, pretrained=pretrained)
     elif type == "unet_senet_hc_cat":
@@ -78,70 +97,230 @@ def create_model(type, input_size, pretrained, parallel):
     else:
         raise Exception("Unsupported model type: '{}".format(type))
 
-    return nn.DataParallel(model) if parallel else model
+    return ModelInput(
+        nn.DataParallel(model) if parallel else model, depth_channels=depth_channels, input_size=input_size)
+
 
+def evaluate(model, data_loader, criterion, phase_timer=None, batch_transform=None):
+    if phase_timer is None:
+        phase_timer = PhaseTimer()
 
-def evaluate(model, data_loader, criterion):
     model.eval()
 
-    loss_sum = 0.0
-    precision_sum = 0.0
+    loss_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
+    precision_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
     step_count = 0
 
     has_salt_criterion = nn.BCEWithLogitsLoss()
 
     with torch.no_grad():
-        for batch in data_loader:
-            images, masks, mask_weights, has_salt = \
-                batch[0].to(device, non_blocking=True), \
-                batch[1].to(device, non_blocking=True), \
-                batch[2].to(device, non_blocking=True), \
-                batch[3].to(device, non_blocking=True)
+        data_loader_iter = iter(data_loader)
+        while True:
+            with phase_timer.phase("data"):
+                batch = next(data_loader_iter, None)
+            if batch is None:
+                break
+
+            with phase_timer.phase("transfer"):
+                batch = [t.to(device, non_blocking=True) for t in batch]
+
+            if batch_transform is not None:
+                with phase_timer.phase("augment"):
+                    batch = batch_transform(batch)
 
-            mask_prediction_logits = model(images)
-            mask_predictions = torch.sigmoid(mask_prediction_logits)
-            criterion.weight = mask_weights
-            loss = criterion(mask_prediction_logits, masks)
+            images, masks, mask_weights, has_salt = batch
 
-            loss_sum += loss.item()
-            precision_sum += np.mean(precision_batch(mask_predictions, masks))
+            with phase_timer.phase("forward"):
+                mask_prediction_logits, _ = split_model_output(model(images))
+                mask_predictions = torch.sigmoid(mask_prediction_logits)
+                criterion.weight = mask_weights
+                loss = criterion(mask_prediction_logits, masks)
+
+            with phase_timer.phase("metric"):
+                loss_sum += loss.double()
+                precision_sum += precision_batch(mask_predictions, masks).mean()
 
+            phase_timer.add_samples(images.size(0))
             step_count += 1
 
-    loss_avg = loss_sum / step_count
-    precision_avg = precision_sum / step_count
+    loss_avg = loss_sum.item() / step_count
+    precision_avg = precision_sum.item() / step_count
 
     return loss_avg, precision_avg
 
 
 def load_ensemble_model(ensemble_model_count, base_dir, val_set_data_loader, criterion, swa_enabled, model_type,
-                        input_size, use_parallel_model):
-    score_to_model = {}
+                        input_size, use_parallel_model, use_depth_channels=False, val_batch_transform=None,
+                        use_salt_classifier=False, empty_threshold=None, val_df=None, prediction_cache_dir=None,
+                        selection="top", target_score=None, member_workers=1):
+    """
+    Selects the ensemble_model_count checkpoints with the best val precision, which are loaded once all checkpoints
+    are scored. With val_df and prediction_cache_dir the TTA probabilities of every checkpoint on it are calculated
+    as well and returned averaged over the ensemble, aligned with val_df, otherwise None is returned for them.
+    The greedy selection, which requires val_df, selects a weighted ensemble of up to ensemble_model_count steps
+    from these probabilities with ensemble_selection.greedy_ensemble_selection instead.
+    The results of the checkpoints are cached by their content hash, persisted to prediction_cache_dir if given, so
+    that a checkpoint is run on the validation set only once.
+    """
+    if selection == "greedy" and val_df is None:
+        raise Exception("Greedy ensemble selection requires the validation set data frame")
+
+    # without a persisted cache the probabilities of the top checkpoints are cheaper to calculate by the ensemble
+    checkpoint_cache = None
+    if val_df is not None and (prediction_cache_dir is not None or selection == "greedy"):
+        val_fingerprint = val_set_fingerprint(
+            val_df, model_type, input_size, use_depth_channels, use_salt_classifier, empty_threshold,
+            type(criterion).__name__, val_batch_transform is not None)
+        checkpoint_cache = CheckpointPredictionCache(val_fingerprint, prediction_cache_dir)
+
     ensemble_model_candidates = glob.glob("{}/model-*.pth".format(base_dir))
     if swa_enabled and os.path.isfile("{}/swa_model.pth".format(base_dir)):
         ensemble_model_candidates.append("{}/swa_model.pth".format(base_dir))
 
-    best_model = None
+    # only the scores and the cache key of a checkpoint are kept while scoring, so a single model is loaded at a time
+    # and the probabilities are read from the cache only for the selection
+    scored_candidates = []
+    candidate_results = {}
     for model_file_path in ensemble_model_candidates:
         model_file_name = os.path.basename(model_file_path)
-        m = create_model(type=model_type, input_size=input_size, pretrained=False, parallel=use_parallel_model).to(
-            device)
-        m.load_state_dict(torch.load(model_file_path, map_location=device))
-        val_loss_avg, val_precision_avg = evaluate(m, val_set_data_loader, criterion)
+
+        checkpoint_hash = file_hash(model_file_path) if checkpoint_cache is not None else None
+        scores = checkpoint_cache.load_scores(checkpoint_hash) if checkpoint_cache is not None else None
+        if scores is None:
+            m = load_checkpoint_model(model_file_path, model_type, input_size, use_parallel_model, use_depth_channels,
+                                      use_salt_classifier, empty_threshold)
+            scores = evaluate(m, val_set_data_loader, criterion, batch_transform=val_batch_transform)
+            if checkpoint_cache is not None:
+                checkpoint_cache.store(checkpoint_hash, *scores, predict_images(val_df, Ensemble([m]), True))
+            del m
+            release_device_memory()
+        val_loss_avg, val_precision_avg = scores
+        candidate_results[model_file_path] = val_loss_avg, val_precision_avg, checkpoint_hash
+
         print("ensemble '%s': val_loss=%.4f, val_precision=%.4f" % (model_file_name, val_loss_avg, val_precision_avg))
-        if len(score_to_model) < ensemble_model_count or min(score_to_model.keys()) < val_precision_avg:
-            if len(score_to_model) >= ensemble_model_count:
-                del score_to_model[min(score_to_model.keys())]
-            score_to_model[val_precision_avg] = m
-        if best_model is None or val_precision_avg > max(score_to_model.keys()):
-            best_model = m
-    ensemble_models = list(score_to_model.values())
+        scored_candidates.append((val_precision_avg, model_file_path))
+
+    if selection == "greedy":
+        stacked_predictions_file_path = None
+        if prediction_cache_dir is not None:
+            stacked_predictions_file_path = \
+                "{}/val-predictions-{}.npy".format(prediction_cache_dir, checkpoint_cache.val_fingerprint)
+        stacked_predictions = stack_predictions(
+            (checkpoint_cache.load_predictions(candidate_results[p][2]) for p in ensemble_model_candidates),
+            len(ensemble_model_candidates), stacked_predictions_file_path)
+        model_indices, ensemble_weights, ensemble_score = greedy_ensemble_selection(
+            stacked_predictions, np.stack(val_df.masks.values), ensemble_model_count, target_score)
+        print("greedy ensemble selection: %d models, score=%.4f" % (len(model_indices), ensemble_score))
+        ensemble_model_file_paths = [ensemble_model_candidates[i] for i in model_indices]
+    else:
+        # the sort is stable, so of equally scored checkpoints the first ones are selected
+        scored_candidates = sorted(scored_candidates, key=lambda c: c[0], reverse=True)[:ensemble_model_count]
+        ensemble_model_file_paths = [model_file_path for _, model_file_path in scored_candidates]
+        ensemble_weights = None
+
+    ensemble_models = []
+    for i, model_file_path in enumerate(ensemble_model_file_paths):
+        val_loss_avg, val_precision_avg, _ = candidate_results[model_file_path]
+        print("ensemble: val_loss=%.4f, val_precision=%.4f, weight=%.3f" % (
+            val_loss_avg, val_precision_avg,
+            ensemble_weights[i] if ensemble_weights is not None else 1.0 / len(ensemble_model_file_paths)))
+        ensemble_models.append(load_checkpoint_model(
+            model_file_path, model_type, input_size, use_parallel_model, use_depth_channels, use_salt_classifier,
+            empty_threshold))
 
-    for ensemble_model in ensemble_models:
-        val_loss_avg, val_precision_avg = evaluate(ensemble_model, val_set_data_loader, criterion)
-        print("ensemble: val_loss=%.4f, val_precision=%.4f" % (val_loss_avg, val_precision_avg))
+    best_model = None
+    if len(ensemble_models) > 0:
+        best_model = ensemble_models[int(np.argmax([candidate_results[p][1] for p in ensemble_model_file_paths]))]
+
+    val_predictions = None
+    if checkpoint_cache is not None:
+        weights = ensemble_weights or [1.0 / len(ensemble_model_file_paths)] * len(ensemble_model_file_paths)
+        val_predictions = np.zeros((len(val_df),) + val_df.images.values[0].shape, dtype=np.float32)
+        for model_file_path, weight in zip(ensemble_model_file_paths, weights):
+            predictions = checkpoint_cache.load_predictions(candidate_results[model_file_path][2])
+            val_predictions += weight * predictions.astype(np.float32)
+        val_predictions = list(val_predictions)
+
+    return best_model, Ensemble(ensemble_models, ensemble_weights, member_workers=member_workers), val_predictions
+
+
+def load_checkpoint_model(model_file_path, model_type, input_size, use_parallel_model, use_depth_channels,
+                          use_salt_classifier, empty_threshold):
+    m = create_model(type=model_type, input_size=input_size, pretrained=False, parallel=use_parallel_model,
+                     depth_channels=use_depth_channels, salt_classifier=use_salt_classifier,
+                     empty_threshold=empty_threshold).to(device)
+    m.load_state_dict(torch.load(model_file_path, map_location=device))
+    return m
+
+
+def load_base_model_state(model, state_dict, use_salt_classifier):
+    """
+    Loads the state of a base model into model. A base model trained without a salt classifier is accepted for a
+    model with one, which then starts with a freshly initialized salt classifier; any other mismatch of the keys is
+    an error.
+    """
+    if not use_salt_classifier:
+        model.load_state_dict(state_dict)
+        return
 
-    return best_model, Ensemble(ensemble_models)
+    model_keys = set(model.state_dict().keys())
+    missing_keys = sorted(k for k in model_keys - set(state_dict.keys()) if ".salt_classifier." not in "." + k)
+    unexpected_keys = sorted(set(state_dict.keys()) - model_keys)
+    if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise Exception("Incompatible base model state, missing keys: {}, unexpected keys: {}".format(
+            missing_keys, unexpected_keys))
+    model.load_state_dict(state_dict, strict=False)
+
+
+def release_device_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def merge_ensemble_model(ensemble_model, val_df, val_predictions, bn_data_loader, bn_batch_transform, model_type,
+                         input_size, use_parallel_model, use_depth_channels, use_salt_classifier=False,
+                         empty_threshold=None, tolerance=0.0):
+    """
+    Merges the models of the ensemble into a single model by the weighted average of their parameters, with the
+    BatchNorm buffers recalculated on bn_data_loader as for SWA. The merged model replaces the ensemble only if its
+    TTA precision on val_df at the best threshold is at most tolerance below the one of the ensemble, given by
+    val_predictions. Returns the model to use, an Ensemble of the merged model if it replaces the ensemble, and its
+    predictions on val_df.
+    """
+    models = list(ensemble_model.models)
+    if len(models) < 2:
+        return ensemble_model, val_predictions
+    if val_predictions is None:
+        val_predictions = predict_images(val_df, ensemble_model, use_tta=True)
+    if not models_compatible(models):
+        print("ensemble merge: the models have different architectures, keeping the ensemble")
+        return ensemble_model, val_predictions
+
+    merged_model = create_model(type=model_type, input_size=input_size, pretrained=False, parallel=use_parallel_model,
+                                depth_channels=use_depth_channels, salt_classifier=use_salt_classifier,
+                                empty_threshold=empty_threshold).to(device)
+    merge_models(merged_model, models, ensemble_model.weights)
+    bn_update(transform_batches(bn_data_loader, bn_batch_transform), merged_model)
+    # the merged model replaces the ensemble, so it predicts probabilities as well
+    merged_model = Ensemble([merged_model])
+
+    merged_val_predictions = predict_images(val_df, merged_model, use_tta=True)
+    masks = np.stack(val_df.masks.values)
+    ensemble_precision = ensemble_score(np.stack(val_predictions), masks)
+    merged_precision = ensemble_score(np.stack(merged_val_predictions), masks)
+    print("ensemble merge: ensemble precision=%.4f, merged precision=%.4f" % (ensemble_precision, merged_precision))
+
+    if merged_precision < ensemble_precision - tolerance:
+        print("ensemble merge: the merged model is worse than the ensemble, keeping the ensemble")
+        return ensemble_model, val_predictions
+    ensemble_model.close()
+    return merged_model, merged_val_predictions
+
+
+def transform_batches(data_loader, batch_transform):
+    for batch in data_loader:
+        batch = [t.to(device, non_blocking=True) for t in batch]
+        yield batch_transform(batch) if batch_transform is not None else batch
 
 
 def create_optimizer(type, model, lr):
@@ -161,6 +340,8 @@ def main():
     print()
 
     input_dir = args.input_dir
+    cache_dir = args.cache_dir
+    decode_workers = args.decode_workers
     output_dir = args.output_dir
     base_model_dir = args.base_model_dir
     image_size_target = args.image_size
@@ -177,8 +358,15 @@ def main():
     loss_type = args.loss
     bce_loss_weight = args.bce_loss_weight
     augment = args.augment
+    elastic_field_bank_size = args.elastic_field_bank_size
+    batch_augment = args.batch_augment
+    collate_mask_weights = args.collate_mask_weights
     model_type = args.model
     use_parallel_model = args.parallel_model
+    use_depth_channels = args.depth_channels
+    use_salt_classifier = args.salt_classifier
+    salt_classifier_loss_weight = args.salt_classifier_loss_weight
+    empty_threshold = args.empty_threshold
     pin_memory = args.pin_memory
     patience = args.patience
     sgdr_cycle_epochs = args.sgdr_cycle_epochs
@@ -187,6 +375,11 @@ def main():
     sgdr_cycle_end_patience = args.sgdr_cycle_end_patience
     max_sgdr_cycles = args.max_sgdr_cycles
     ensemble_model_count = args.ensemble_model_count
+    ensemble_selection = args.ensemble_selection
+    ensemble_target_score = args.ensemble_target_score
+    ensemble_merge = args.ensemble_merge
+    ensemble_member_workers = args.ensemble_member_workers
+    ensemble_merge_tolerance = args.ensemble_merge_tolerance
     swa_enabled = args.swa_enabled
     swa_epoch_to_start = args.swa_epoch_to_start
     fold_count = args.fold_count
@@ -200,6 +393,11 @@ def main():
     pseudo_labeling_extend_val_set = args.pl_extend_val_set
     pseudo_labeling_loss_weight_factor = args.pl_loss_weight_factor
     submit = args.submit
+    metrics_sync_steps = args.metrics_sync_steps
+    phase_timing_sync = args.phase_timing_sync
+    use_prediction_cache = args.prediction_cache
+    prediction_cache_dir = args.prediction_cache_dir or "{}/prediction_cache".format(output_dir)
+    blank_prediction = args.blank_prediction if args.blank_fast_path else None
 
     train_data = TrainData(
         input_dir,
@@ -210,42 +408,61 @@ def main():
         pseudo_labeling_submission_csv,
         pseudo_labeling_test_fold_count,
         pseudo_labeling_test_fold_index,
-        pseudo_labeling_extend_val_set)
+        pseudo_labeling_extend_val_set,
+        cache_dir=cache_dir,
+        decode_workers=decode_workers)
 
     train_set = TrainDataset(
         train_data.train_set_df,
         image_size_target,
         augment=augment,
         train_set_scale_factor=train_set_scale_factor,
-        pseudo_mask_weight_scale_factor=pseudo_labeling_loss_weight_factor)
+        pseudo_mask_weight_scale_factor=pseudo_labeling_loss_weight_factor,
+        elastic_field_bank_size=elastic_field_bank_size,
+        raw=batch_augment,
+        collate_mask_weights=collate_mask_weights)
 
-    train_set_data_loader = \
-        DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=pin_memory)
+    train_set_data_loader = DataLoader(
+        train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers, pin_memory=pin_memory,
+        collate_fn=train_set.collate)
 
     val_set = TrainDataset(
         train_data.val_set_df,
         image_size_target,
         augment=False,
         train_set_scale_factor=1.0,
-        pseudo_mask_weight_scale_factor=pseudo_labeling_loss_weight_factor)
+        pseudo_mask_weight_scale_factor=pseudo_labeling_loss_weight_factor,
+        raw=batch_augment,
+        collate_mask_weights=collate_mask_weights)
 
-    val_set_data_loader = \
-        DataLoader(val_set, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=pin_memory)
+    val_set_data_loader = DataLoader(
+        val_set, batch_size=batch_size, shuffle=False, num_workers=2, pin_memory=pin_memory, collate_fn=val_set.collate)
+
+    if batch_augment:
+        train_batch_transform = BatchTransform(image_size_target, augment=augment)
+        val_batch_transform = BatchTransform(image_size_target, augment=False)
+    else:
+        train_batch_transform = None
+        val_batch_transform = None
 
     if base_model_dir:
         for model_file_path in glob.glob("{}/model*.pth".format(base_model_dir)):
             copyfile(model_file_path, "{}/{}".format(output_dir, os.path.basename(model_file_path)))
         model = create_model(type=model_type, input_size=image_size_target, pretrained=False,
-                             parallel=use_parallel_model).to(device)
-        model.load_state_dict(torch.load("{}/model.pth".format(output_dir), map_location=device))
+                             parallel=use_parallel_model, depth_channels=use_depth_channels,
+                             salt_classifier=use_salt_classifier, empty_threshold=empty_threshold).to(device)
+        load_base_model_state(
+            model, torch.load("{}/model.pth".format(output_dir), map_location=device), use_salt_classifier)
     else:
         model = create_model(type=model_type, input_size=image_size_target, pretrained=True,
-                             parallel=use_parallel_model).to(device)
+                             parallel=use_parallel_model, depth_channels=use_depth_channels,
+                             salt_classifier=use_salt_classifier, empty_threshold=empty_threshold).to(device)
 
     torch.save(model.state_dict(), "{}/model.pth".format(output_dir))
 
     swa_model = create_model(type=model_type, input_size=image_size_target, pretrained=False,
-                             parallel=use_parallel_model).to(device)
+                             parallel=use_parallel_model, depth_channels=use_depth_channels,
+                             salt_classifier=use_salt_classifier, empty_threshold=empty_threshold).to(device)
 
     if pseudo_labeling_submission_csv:
         copyfile(pseudo_labeling_submission_csv, "{}/{}".format(output_dir, "base_pseudo_labeling_submission.csv"))
@@ -268,7 +485,7 @@ def main():
     optimizer = create_optimizer(optimizer_type, model, lr_max)
     lr_scheduler = CosineAnnealingLR(optimizer, T_max=sgdr_cycle_epochs, eta_min=lr_min)
 
-    optim_summary_writer = SummaryWriter(log_dir="{}/logs/optim".format(output_dir))
+    optim_summary_writer = BufferedSummaryWriter(SummaryWriter(log_dir="{}/logs/optim".format(output_dir)))
     train_summary_writer = SummaryWriter(log_dir="{}/logs/train".format(output_dir))
     val_summary_writer = SummaryWriter(log_dir="{}/logs/val".format(output_dir))
     swa_val_summary_writer = SummaryWriter(log_dir="{}/logs/swa_val".format(output_dir))
@@ -297,9 +514,22 @@ def main():
         print('{"chart": "swa_val_precision", "axis": "epoch"}')
         print('{"chart": "swa_val_loss", "axis": "epoch"}')
     print('{"chart": "lr_scaled", "axis": "epoch"}')
+    for phase in train_phases:
+        print('{"chart": "time_train_%s", "axis": "epoch"}' % phase)
+    if use_val_set:
+        for phase in eval_phases:
+            print('{"chart": "time_val_%s", "axis": "epoch"}' % phase)
+    for phase in epoch_phases:
+        print('{"chart": "time_epoch_%s", "axis": "epoch"}' % phase)
+
+    train_phase_timer = PhaseTimer(phase_timing_sync)
+    val_phase_timer = PhaseTimer(phase_timing_sync)
+    epoch_phase_timer = PhaseTimer(phase_timing_sync)
 
     train_start_time = time.time()
 
+    has_salt_criterion = nn.BCEWithLogitsLoss()
+
     if loss_type == "bce":
         criterion = nn.BCEWithLogitsLoss()
     elif loss_type == "lovasz":
@@ -318,10 +548,15 @@ def main():
     for epoch in range(epochs_to_train):
         epoch_start_time = time.time()
 
+        epoch_train_phase_timer = PhaseTimer(phase_timing_sync)
+        epoch_val_phase_timer = PhaseTimer(phase_timing_sync)
+        epoch_epoch_phase_timer = PhaseTimer(phase_timing_sync)
+
         model.train()
 
-        train_loss_sum = 0.0
-        train_precision_sum = 0.0
+        # the running sums stay on the device and are synchronized with the host only once per epoch
+        train_loss_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
+        train_precision_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
 
         # image_size_target = image_sizes[min(epoch // 8, len(image_sizes) - 1)]
         # train_set.image_size_target = image_size_target
@@ -334,35 +569,51 @@ def main():
 
             optimizer.zero_grad()
 
-            batch_loss_sum = 0.0
-            batch_precision_sum = 0.0
+            batch_loss_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
+            batch_precision_sum = torch.tensor(0.0, dtype=torch.float64, device=device)
 
             batch_iter_count = 0
             for _ in range(batch_iters):
-                try:
-                    batch = next(train_set_data_loader_iter)
-                except StopIteration:
+                # unless the batch is augmented after collation, augmentation runs in the data loader workers and
+                # its cost shows up in the data phase
+                with epoch_train_phase_timer.phase("data"):
+                    batch = next(train_set_data_loader_iter, None)
+                if batch is None:
                     break
 
-                images, masks, mask_weights, has_salt = \
-                    batch[0].to(device, non_blocking=True), \
-                    batch[1].to(device, non_blocking=True), \
-                    batch[2].to(device, non_blocking=True), \
-                    batch[3].to(device, non_blocking=True)
+                with epoch_train_phase_timer.phase("transfer"):
+                    batch = [t.to(device, non_blocking=True) for t in batch]
 
-                mask_prediction_logits = model(images)
-                criterion.weight = mask_weights
-                loss = criterion(mask_prediction_logits, masks)
-                loss.backward()
+                if train_batch_transform is not None:
+                    with epoch_train_phase_timer.phase("augment"):
+                        batch = train_batch_transform(batch)
 
-                with torch.no_grad():
-                    batch_loss_sum += loss.item()
+                images, masks, mask_weights, has_salt = batch
+
+                with epoch_train_phase_timer.phase("forward"):
+                    mask_prediction_logits, has_salt_logits = split_model_output(model(images))
+                    criterion.weight = mask_weights
+                    loss = criterion(mask_prediction_logits, masks)
+                    if has_salt_logits is not None:
+                        loss = loss + salt_classifier_loss_weight * has_salt_criterion(has_salt_logits, has_salt)
+
+                with epoch_train_phase_timer.phase("backward"):
+                    loss.backward()
+
+                with epoch_train_phase_timer.phase("metric"), torch.no_grad():
+                    batch_loss_sum += loss.double()
                     mask_predictions = torch.sigmoid(mask_prediction_logits)
-                    batch_precision_sum += np.mean(precision_batch(mask_predictions, masks))
+                    batch_precision_sum += precision_batch(mask_predictions, masks).mean()
 
+                epoch_train_phase_timer.add_samples(images.size(0))
                 batch_iter_count += 1
 
-            optimizer.step()
+            # the device side sums would turn an empty step into NaN metrics instead of failing
+            if batch_iter_count == 0:
+                raise Exception("The train data loader produced no batches for a step of epoch {}".format(epoch + 1))
+
+            with epoch_train_phase_timer.phase("optimizer"):
+                optimizer.step()
 
             train_loss_sum += batch_loss_sum / batch_iter_count
             train_precision_sum += batch_precision_sum / batch_iter_count
@@ -371,24 +622,32 @@ def main():
             batch_count += 1
 
             optim_summary_writer.add_scalar("lr", get_learning_rate(optimizer), batch_count + 1)
+            optim_summary_writer.add_scalar("batch_loss", batch_loss_sum / batch_iter_count, batch_count + 1)
+            if metrics_sync_steps > 0 and batch_count % metrics_sync_steps == 0:
+                optim_summary_writer.flush()
 
-        train_loss_avg = train_loss_sum / epoch_iterations
-        train_precision_avg = train_precision_sum / epoch_iterations
+        train_loss_avg = train_loss_sum.item() / epoch_iterations
+        train_precision_avg = train_precision_sum.item() / epoch_iterations
 
         if use_val_set:
-            val_loss_avg, val_precision_avg = evaluate(model, val_set_data_loader, criterion)
+            with epoch_epoch_phase_timer.phase("evaluate"):
+                val_loss_avg, val_precision_avg = evaluate(
+                    model, val_set_data_loader, criterion, phase_timer=epoch_val_phase_timer,
+                    batch_transform=val_batch_transform)
         else:
             val_loss_avg, val_precision_avg = train_loss_avg, train_precision_avg
 
         model_improved_within_sgdr_cycle = val_precision_avg > sgdr_cycle_val_precision_best_avg
         if model_improved_within_sgdr_cycle:
-            torch.save(model.state_dict(), "{}/model-{}.pth".format(output_dir, ensemble_model_index))
+            with epoch_epoch_phase_timer.phase("checkpoint"):
+                torch.save(model.state_dict(), "{}/model-{}.pth".format(output_dir, ensemble_model_index))
             sgdr_cycle_val_precision_best_avg = val_precision_avg
 
         model_improved = val_precision_avg > global_val_precision_best_avg
         ckpt_saved = False
         if model_improved:
-            torch.save(model.state_dict(), "{}/model.pth".format(output_dir))
+            with epoch_epoch_phase_timer.phase("checkpoint"):
+                torch.save(model.state_dict(), "{}/model.pth".format(output_dir))
             global_val_precision_best_avg = val_precision_avg
             epoch_of_last_improval = epoch
             ckpt_saved = True
@@ -396,19 +655,23 @@ def main():
         sgdr_reset = False
         if (epoch + 1 >= sgdr_next_cycle_end_epoch) and (epoch - epoch_of_last_improval >= sgdr_cycle_end_patience):
             if swa_enabled and epoch + 1 >= swa_epoch_to_start:
-                m = create_model(type=model_type, input_size=image_size_target, pretrained=False,
-                                 parallel=use_parallel_model).to(device)
-                m.load_state_dict(
-                    torch.load("{}/model-{}.pth".format(output_dir, ensemble_model_index), map_location=device))
-                swa_update_count += 1
-                moving_average(swa_model, m, 1.0 / swa_update_count)
-                bn_update(train_set_data_loader, swa_model)
-
-                swa_val_loss_avg, swa_val_precision_avg = evaluate(swa_model, val_set_data_loader, criterion)
+                with epoch_epoch_phase_timer.phase("swa"):
+                    m = create_model(type=model_type, input_size=image_size_target, pretrained=False,
+                                     parallel=use_parallel_model, depth_channels=use_depth_channels,
+                                     salt_classifier=use_salt_classifier, empty_threshold=empty_threshold).to(device)
+                    m.load_state_dict(
+                        torch.load("{}/model-{}.pth".format(output_dir, ensemble_model_index), map_location=device))
+                    swa_update_count += 1
+                    moving_average(swa_model, m, 1.0 / swa_update_count)
+                    bn_update(transform_batches(train_set_data_loader, train_batch_transform), swa_model)
+
+                    swa_val_loss_avg, swa_val_precision_avg = \
+                        evaluate(swa_model, val_set_data_loader, criterion, batch_transform=val_batch_transform)
 
                 swa_model_improved = swa_val_precision_avg > global_swa_val_precision_best_avg
                 if swa_model_improved:
-                    torch.save(swa_model.state_dict(), "{}/swa_model.pth".format(output_dir))
+                    with epoch_epoch_phase_timer.phase("checkpoint"):
+                        torch.save(swa_model.state_dict(), "{}/swa_model.pth".format(output_dir))
                     global_swa_val_precision_best_avg = swa_val_precision_avg
 
                 swa_val_summary_writer.add_scalar("loss", swa_val_loss_avg, epoch + 1)
@@ -433,6 +696,7 @@ def main():
             lr_scheduler = CosineAnnealingLR(optimizer, T_max=current_sgdr_cycle_epochs, eta_min=new_lr_min)
 
         optim_summary_writer.add_scalar("sgdr_cycle", sgdr_cycle_count, epoch + 1)
+        optim_summary_writer.flush()
 
         train_summary_writer.add_scalar("loss", train_loss_avg, epoch + 1)
         train_summary_writer.add_scalar("precision", train_precision_avg, epoch + 1)
@@ -440,6 +704,19 @@ def main():
         val_summary_writer.add_scalar("loss", val_loss_avg, epoch + 1)
         val_summary_writer.add_scalar("precision", val_precision_avg, epoch + 1)
 
+        for phase in train_phases:
+            train_summary_writer.add_scalar("time/%s" % phase, epoch_train_phase_timer.total(phase), epoch + 1)
+        if use_val_set:
+            for phase in eval_phases:
+                val_summary_writer.add_scalar("time/%s" % phase, epoch_val_phase_timer.total(phase), epoch + 1)
+        for phase in epoch_phases:
+            optim_summary_writer.add_scalar("time/%s" % phase, epoch_epoch_phase_timer.total(phase), epoch + 1)
+        optim_summary_writer.flush()
+
+        train_phase_timer.merge(epoch_train_phase_timer)
+        val_phase_timer.merge(epoch_val_phase_timer)
+        epoch_phase_timer.merge(epoch_epoch_phase_timer)
+
         epoch_end_time = time.time()
         epoch_duration_time = epoch_end_time - epoch_start_time
 
@@ -464,6 +741,16 @@ def main():
         print('{"chart": "precision", "x": %d, "y": %.4f}' % (epoch + 1, train_precision_avg))
         print('{"chart": "loss", "x": %d, "y": %.4f}' % (epoch + 1, train_loss_avg))
         print('{"chart": "lr_scaled", "x": %d, "y": %.4f}' % (epoch + 1, 1000 * get_learning_rate(optimizer)))
+        for phase in train_phases:
+            print('{"chart": "time_train_%s", "x": %d, "y": %.2f}' % (
+                phase, epoch + 1, epoch_train_phase_timer.total(phase)))
+        if use_val_set:
+            for phase in eval_phases:
+                print('{"chart": "time_val_%s", "x": %d, "y": %.2f}' % (
+                    phase, epoch + 1, epoch_val_phase_timer.total(phase)))
+        for phase in epoch_phases:
+            print('{"chart": "time_epoch_%s", "x": %d, "y": %.2f}' % (
+                phase, epoch + 1, epoch_epoch_phase_timer.total(phase)))
 
         if sgdr_reset and sgdr_cycle_count >= ensemble_model_count and epoch - epoch_of_last_improval >= patience:
             print("early abort due to lack of improval")
@@ -480,6 +767,13 @@ def main():
     train_end_time = time.time()
     print()
     print("Train time: %s" % str(datetime.timedelta(seconds=train_end_time - train_start_time)))
+    print()
+    print(train_phase_timer.summary("train"))
+    if use_val_set:
+        print()
+        print(val_phase_timer.summary("val"))
+    print()
+    print(epoch_phase_timer.summary("epoch"))
 
     eval_start_time = time.time()
 
@@ -487,32 +781,60 @@ def main():
     print("evaluation of the training model")
 
     if use_val_set:
-        best_model, ensemble_model = load_ensemble_model(
+        best_model, ensemble_model, val_predictions = load_ensemble_model(
             ensemble_model_count, output_dir, val_set_data_loader, criterion, swa_enabled, model_type,
-            image_size_target, use_parallel_model=use_parallel_model)
-
-        no_pseudo_labels_val_set_df = \
-            train_data.val_set_df.drop(train_data.val_set_df.index[train_data.val_set_df.pseudo_masked]).copy()
+            image_size_target, use_parallel_model=use_parallel_model, use_depth_channels=use_depth_channels,
+            val_batch_transform=val_batch_transform, use_salt_classifier=use_salt_classifier,
+            empty_threshold=empty_threshold, val_df=train_data.val_set_df, prediction_cache_dir=prediction_cache_dir,
+            selection=ensemble_selection, target_score=ensemble_target_score,
+            member_workers=ensemble_member_workers)
+
+        pseudo_masked = train_data.val_set_df.pseudo_masked.values
+        no_pseudo_labels_val_set_df = train_data.val_set_df.drop(train_data.val_set_df.index[pseudo_masked]).copy()
+        no_pseudo_labels_val_predictions = None
+        if val_predictions is not None:
+            no_pseudo_labels_val_predictions = [p for p, pm in zip(val_predictions, pseudo_masked) if not pm]
+
+        if ensemble_merge:
+            ensemble_model, no_pseudo_labels_val_predictions = merge_ensemble_model(
+                ensemble_model, no_pseudo_labels_val_set_df, no_pseudo_labels_val_predictions, train_set_data_loader,
+                train_batch_transform, model_type, image_size_target, use_parallel_model, use_depth_channels,
+                use_salt_classifier=use_salt_classifier, empty_threshold=empty_threshold,
+                tolerance=ensemble_merge_tolerance)
 
         print()
         print("analyze validation set using ensemble model and w/ TTA")
         print()
-        mask_threshold, best_mask_per_cc = analyze(ensemble_model, no_pseudo_labels_val_set_df, use_tta=True)
+        mask_threshold, best_mask_per_cc = analyze(
+            ensemble_model, no_pseudo_labels_val_set_df, use_tta=True, predictions=no_pseudo_labels_val_predictions)
     else:
-        best_model, ensemble_model = load_ensemble_model(
+        best_model, ensemble_model, val_predictions = load_ensemble_model(
             ensemble_model_count, output_dir, train_set_data_loader, criterion, swa_enabled, model_type,
-            image_size_target, use_parallel_model=use_parallel_model)
+            image_size_target, use_parallel_model=use_parallel_model, use_depth_channels=use_depth_channels,
+            val_batch_transform=train_batch_transform, use_salt_classifier=use_salt_classifier,
+            empty_threshold=empty_threshold, val_df=train_data.train_set_df, prediction_cache_dir=prediction_cache_dir,
+            selection=ensemble_selection, target_score=ensemble_target_score,
+            member_workers=ensemble_member_workers)
+
+        if ensemble_merge:
+            ensemble_model, val_predictions = merge_ensemble_model(
+                ensemble_model, train_data.train_set_df, val_predictions, train_set_data_loader, train_batch_transform,
+                model_type, image_size_target, use_parallel_model, use_depth_channels,
+                use_salt_classifier=use_salt_classifier, empty_threshold=empty_threshold,
+                tolerance=ensemble_merge_tolerance)
 
         print()
         print("analyze validation set using ensemble model and w/ TTA")
         print()
-        mask_threshold, best_mask_per_cc = analyze(ensemble_model, train_data.train_set_df, use_tta=True)
+        mask_threshold, best_mask_per_cc = analyze(
+            ensemble_model, train_data.train_set_df, use_tta=True, predictions=val_predictions)
 
     eval_end_time = time.time()
     print()
     print("Eval time: %s" % str(datetime.timedelta(seconds=eval_end_time - eval_start_time)))
 
     if not submit:
+        ensemble_model.close()
         return
 
     print()
@@ -520,8 +842,13 @@ def main():
 
     submission_start_time = time.time()
 
-    test_data = TestData(input_dir)
-    calculate_predictions(test_data.df, ensemble_model, use_tta=True)
+    test_data = TestData(input_dir, cache_dir=cache_dir, decode_workers=decode_workers)
+    prediction_cache = None
+    if use_prediction_cache:
+        prediction_cache = PredictionCache(
+            model_fingerprint(ensemble_model, use_tta=True), prediction_cache_dir, blank_prediction)
+    calculate_predictions(test_data.df, ensemble_model, use_tta=True, prediction_cache=prediction_cache)
+    ensemble_model.close()
     calculate_predictions_cc(test_data.df, mask_threshold)
     calculate_prediction_masks(test_data.df, mask_threshold)
     calculate_best_prediction_masks(test_data.df, best_mask_per_cc)
@@ -542,6 +869,8 @@ if __name__ == "__main__":
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--input_dir", default="/storage/kaggle/tgs")
     argparser.add_argument("--output_dir", default="/artifacts")
+    argparser.add_argument("--cache_dir")
+    argparser.add_argument("--decode_workers", type=int)
     argparser.add_argument("--base_model_dir")
     argparser.add_argument("--image_size", default=128, type=int)
     argparser.add_argument("--epochs", default=500, type=int)
@@ -555,18 +884,30 @@ if __name__ == "__main__":
     argparser.add_argument("--lr_max_decay", default=1.0, type=float)
     argparser.add_argument("--model", default="unet_seresnext50_hc")
     argparser.add_argument("--parallel_model", default=True, type=str2bool)
+    argparser.add_argument("--depth_channels", default=False, type=str2bool)
+    argparser.add_argument("--salt_classifier", default=False, type=str2bool)
+    argparser.add_argument("--salt_classifier_loss_weight", default=0.1, type=float)
+    argparser.add_argument("--empty_threshold", type=float)
     argparser.add_argument("--pin_memory", default=False, type=str2bool)
     argparser.add_argument("--patience", default=30, type=int)
     argparser.add_argument("--optimizer", default="adam")
     argparser.add_argument("--loss", default="bce")
     argparser.add_argument("--bce_loss_weight", default=0.3, type=float)
     argparser.add_argument("--augment", default=True, type=str2bool)
+    argparser.add_argument("--elastic_field_bank_size", default=0, type=int)
+    argparser.add_argument("--batch_augment", default=False, type=str2bool)
+    argparser.add_argument("--collate_mask_weights", default=False, type=str2bool)
     argparser.add_argument("--sgdr_cycle_epochs", default=20, type=int)
     argparser.add_argument("--sgdr_cycle_epochs_mult", default=1.0, type=float)
     argparser.add_argument("--sgdr_cycle_end_prolongation", default=3, type=int)
     argparser.add_argument("--sgdr_cycle_end_patience", default=3, type=int)
     argparser.add_argument("--max_sgdr_cycles", default=None, type=int)
     argparser.add_argument("--ensemble_model_count", default=3, type=int)
+    argparser.add_argument("--ensemble_selection", default="top", choices=["top", "greedy"])
+    argparser.add_argument("--ensemble_target_score", type=float)
+    argparser.add_argument("--ensemble_merge", default=False, type=str2bool)
+    argparser.add_argument("--ensemble_merge_tolerance", default=0.005, type=float)
+    argparser.add_argument("--ensemble_member_workers", default=1, type=int)
     argparser.add_argument("--swa_enabled", default=False, type=str2bool)
     argparser.add_argument("--swa_epoch_to_start", default=0, type=int)
     argparser.add_argument("--fold_count", default=5, type=int)
@@ -580,5 +921,11 @@ if __name__ == "__main__":
     argparser.add_argument("--pl_extend_val_set", default=False, type=str2bool)
     argparser.add_argument("--pl_loss_weight_factor", default=0.6, type=float)
     argparser.add_argument("--submit", default=True, type=str2bool)
+    argparser.add_argument("--metrics_sync_steps", default=0, type=int)
+    argparser.add_argument("--phase_timing_sync", default=False, type=str2bool)
+    argparser.add_argument("--prediction_cache", default=False, type=str2bool)
+    argparser.add_argument("--prediction_cache_dir")
+    argparser.add_argument("--blank_fast_path", default=False, type=str2bool)
+    argparser.add_argument("--blank_prediction", default=0.0, type=float)
 
     main()
@@ -7,6 +7,7 @@ from torch.utils import model_zoo
 from torchvision.models import ResNet
 from torchvision.models.resnet import model_urls
 
+from salt_classifier import SaltClassifier, decode_non_empty
 from se_models import SEBasicBlock, SpatialChannelSEBlock
 
 
@@ -46,9 +47,13 @@ class DecoderBlock(nn.Module):
 
 
 class UNetResNetHc(nn.Module):
-    def __init__(self, num_classes, input_size, num_filters=32, dropout_2d=0.2, pretrained=False):
+    def __init__(self, num_classes, input_size, num_filters=32, dropout_2d=0.2, pretrained=False,
+                 salt_classifier=False, empty_threshold=None):
         super().__init__()
+        self.num_classes = num_classes
+        self.input_size = input_size
         self.dropout_2d = dropout_2d
+        self.empty_threshold = empty_threshold
 
         self.encoder = ResNet(SEBasicBlock, [3, 4, 6, 3])
         if pretrained:
@@ -61,6 +66,9 @@ class UNetResNetHc(nn.Module):
         self.conv3 = self.encoder.layer3
         self.conv4 = self.encoder.layer4
 
+        # with a salt classifier the decoder is skipped in eval mode for the tiles predicted empty
+        self.salt_classifier = SaltClassifier(bottom_channel_nr) if salt_classifier else None
+
         dec_in_channels = [
             bottom_channel_nr,
             bottom_channel_nr // 2 + num_filters * 8,
@@ -103,6 +111,18 @@ class UNetResNetHc(nn.Module):
         conv3 = self.conv3(conv2)
         center = self.conv4(conv3)
 
+        if self.salt_classifier is None:
+            return self.decode(conv1, conv2, conv3, center), None
+
+        has_salt_logits = self.salt_classifier(center)
+        if self.training or self.empty_threshold is None:
+            return self.decode(conv1, conv2, conv3, center), has_salt_logits
+
+        f = decode_non_empty(self.decode, [conv1, conv2, conv3, center], has_salt_logits, self.empty_threshold,
+                             (self.num_classes, self.input_size, self.input_size))
+        return f, has_salt_logits
+
+    def decode(self, conv1, conv2, conv3, center):
         dec4, dec4_input = self.dec4(center)
         dec3, dec3_input = self.dec3(torch.cat([dec4, conv3], 1))
         dec2, dec2_input = self.dec2(torch.cat([dec3, conv2], 1))
@@ -110,4 +130,4 @@ class UNetResNetHc(nn.Module):
 
         out = dec1 + dec1_input + dec2_input + dec3_input + dec4_input
 
-        return self.final(F.dropout2d(out, p=self.dropout_2d)), None
+        return self.final(F.dropout2d(out, p=self.dropout_2d))
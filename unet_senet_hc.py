@@ -5,6 +5,7 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
+from salt_classifier import SaltClassifier, decode_non_empty
 from se_models import SpatialChannelSEBlock
 from senet import senet154, se_resnext50_32x4d, se_resnext101_32x4d
 
@@ -45,9 +46,13 @@ class DecoderBlock(nn.Module):
 
 
 class UNetSeNetHc(nn.Module):
-    def __init__(self, backbone, num_classes, input_size, num_filters=32, dropout_2d=0.2, pretrained=False):
+    def __init__(self, backbone, num_classes, input_size, num_filters=32, dropout_2d=0.2, pretrained=False,
+                 salt_classifier=False, empty_threshold=None):
         super().__init__()
+        self.num_classes = num_classes
+        self.input_size = input_size
         self.dropout_2d = dropout_2d
+        self.empty_threshold = empty_threshold
 
         if backbone == "senet154":
             self.encoder = senet154(pretrained="imagenet" if pretrained else None)
@@ -91,6 +96,9 @@ class UNetSeNetHc(nn.Module):
         self.conv3 = self.encoder.layer3
         self.conv4 = self.encoder.layer4
 
+        # with a salt classifier the decoder is skipped in eval mode for the tiles predicted empty
+        self.salt_classifier = SaltClassifier(bottom_channel_nr) if salt_classifier else None
+
         dec_in_channels = [
             bottom_channel_nr,
             bottom_channel_nr // 2 + num_filters * 8,
@@ -133,6 +141,18 @@ class UNetSeNetHc(nn.Module):
         conv3 = self.conv3(conv2)
         center = self.conv4(conv3)
 
+        if self.salt_classifier is None:
+            return self.decode(conv1, conv2, conv3, center)
+
+        has_salt_logits = self.salt_classifier(center)
+        if self.training or self.empty_threshold is None:
+            return self.decode(conv1, conv2, conv3, center), has_salt_logits
+
+        f = decode_non_empty(self.decode, [conv1, conv2, conv3, center], has_salt_logits, self.empty_threshold,
+                             (self.num_classes, self.input_size, self.input_size))
+        return f, has_salt_logits
+
+    def decode(self, conv1, conv2, conv3, center):
         dec4, dec4_input = self.dec4(center)
         dec3, dec3_input = self.dec3(torch.cat([dec4, conv3], 1))
         dec2, dec2_input = self.dec2(torch.cat([dec3, conv2], 1))
@@ -140,6 +160,4 @@ class UNetSeNetHc(nn.Module):
 
         out = dec1 + dec1_input + dec2_input + dec3_input + dec4_input
 
-        f = self.final(F.dropout2d(out, p=self.dropout_2d))
-
-        return f
+        return self.final(F.dropout2d(out, p=self.dropout_2d))
@@ -1,10 +1,9 @@
-from multiprocessing import Pool
-
+import numpy as np
 import pandas as pd
 from sklearn.model_selection import StratifiedKFold
 from torch import nn
 
-from processing import rlenc
+from processing import rlenc_batch
 
 
 def adjust_learning_rate(optimizer, lr):
@@ -34,8 +33,7 @@ def unfreeze(model):
 
 
 def write_submission(df, mask_name, file_path):
-    with Pool(16) as pool:
-        rlenc_results = [r for r in pool.map(rlenc, df[mask_name])]
+    rlenc_results = rlenc_batch(np.stack(df[mask_name].values))
     pred_dict = {idx: r for idx, r in zip(df.index.values, rlenc_results)}
     sub = pd.DataFrame.from_dict(pred_dict, orient='index')
     sub.index.names = ["id"]
@@ -43,6 +41,29 @@ def write_submission(df, mask_name, file_path):
     sub.to_csv(file_path)
 
 
+class BufferedSummaryWriter:
+    """
+    Collects scalars, which may still be device tensors, and hands them to the wrapped summary writer on flush,
+    so that per step logging neither synchronizes with the device nor writes events in the training loop.
+    """
+
+    def __init__(self, summary_writer):
+        self.summary_writer = summary_writer
+        self.scalars = []
+
+    def add_scalar(self, tag, scalar_value, global_step):
+        self.scalars.append((tag, scalar_value, global_step))
+
+    def flush(self):
+        for tag, scalar_value, global_step in self.scalars:
+            self.summary_writer.add_scalar(tag, float(scalar_value), global_step)
+        self.scalars = []
+
+    def close(self):
+        self.flush()
+        self.summary_writer.close()
+
+
 def kfold_split(n_splits, values, classes):
     skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=42)
     for train_value_indexes, test_value_indexes in skf.split(values, classes):